@@ -0,0 +1,468 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Local stand-in for the parts of the OVH API used by the inventory and the
+# modules, to benchmark them without an account or API quota.
+#
+# Serves /auth/time, /vps[/{name}[/ips[/{ip}]]], /dedicated/server[/{name}[/ips]],
+# POST /vps/{name}/{reboot,start,stop,reinstall}, /vps/{name}/tasks/{id},
+# /vps/{name}/templates[/{id}], /ip[?routedTo.serviceName=][/{block}], /cloud/project[/{id}[/instance]]
+# and /me/sshKey[/{name}],
+# with the ?$batch=, syntax, an injected latency and a rate of 429 answers.
+# Signatures are not checked, any credentials do.
+#
+# Half of the fleet are VPS (vps<i>.bench), the other half dedicated servers
+# (ns<i>.bench), generated from their index so large fleets cost no memory.
+#
+# Control endpoints, outside of the API:
+#   GET /_stats      requests per endpoint template, DELETE /_stats resets them
+#   POST /_control   JSON body, any of fleet, latency (seconds), throttle (rate),
+#                    task_duration (seconds before VPS tasks are done),
+#                    cloud (Public Cloud instances, over CLOUD_PROJECTS projects)
+#
+# Usage: bench/mock_api.py [--port 8080] [--fleet 100] [--latency 0.02] [--throttle 0.01]
+#        then point the inventory regions (or OVH_ENDPOINT) to http://127.0.0.1:<port>/1.0
+
+from __future__ import print_function
+
+import argparse
+import json
+import random
+import re
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+    from urlparse import urlparse, parse_qs
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import urlparse, parse_qs, unquote
+
+API_PREFIX = '/1.0'
+CLOUD_PROJECTS = 4
+# id, name, distribution and bits of the templates of every VPS model
+TEMPLATES = [
+    (139, "Debian 9 (Stretch)", "debian9", 64),
+    (140, "Debian 10 (Buster)", "debian10", 64),
+    (141, "Debian 10 - Plesk Onyx", "debian10", 64),
+    (142, "Ubuntu 18.04 Server", "ubuntu1804", 64),
+    (143, "Centos 7", "centos7", 64),
+]
+
+
+class NotFound(Exception):
+    pass
+
+
+class Fleet(object):
+    """ Services, IPs and ssh keys of the fake account """
+
+    def __init__(self, size, task_duration=0.0, cloud=0):
+        self.size = size
+        self.cloud = cloud
+        self.task_duration = task_duration
+        self.keys = dict()
+        self.tasks = dict()
+        # VPS states changed by their tasks, running otherwise
+        self.states = dict()
+        self.lock = threading.Lock()
+
+    def vps_names(self):
+        return ['vps{}.bench'.format(i) for i in range(self.size - self.size // 2)]
+
+    def server_names(self):
+        return ['ns{}.bench'.format(i) for i in range(self.size // 2)]
+
+    def index(self, name, prefix, count):
+        match = re.match(r'^{}(\d+)\.bench$'.format(prefix), name)
+        if match is None or int(match.group(1)) >= count:
+            raise NotFound(name)
+        return int(match.group(1))
+
+    def vps(self, name):
+        i = self.index(name, 'vps', self.size - self.size // 2)
+        return {
+            "name": name,
+            "displayName": name,
+            "state": self.states.get(name, "running"),
+            "zone": "Region OpenStack: os-gra{}".format(i % 3 + 1),
+            "offerType": "ssd",
+            "model": {"name": "vps-ssd-{}".format(i % 3 + 1), "offer": "VPS SSD", "memory": 2048, "disk": 20, "vcore": 1},
+            "memoryLimit": 2048,
+            "vcore": 1,
+            "keymap": None,
+            "netbootMode": "local",
+            "slaMonitoring": False,
+            "monitoringIpBlocks": [],
+            "cluster": "cluster{}".format(i % 7),
+        }
+
+    def vps_ips(self, name):
+        i = self.index(name, 'vps', self.size - self.size // 2)
+        return ['10.{}.{}.{}'.format(i >> 16 & 255, i >> 8 & 255, i & 255),
+                '2001:db8:{:x}::1'.format(i)]
+
+    def vps_ip(self, name, ip):
+        if ip not in self.vps_ips(name):
+            raise NotFound(ip)
+        return {
+            "ipAddress": ip,
+            "version": "v6" if ':' in ip else "v4",
+            "type": "primary",
+            "gateway": None,
+            "macAddress": None,
+            "reverse": None,
+            "geolocation": "fr",
+        }
+
+    def vps_templates(self, name):
+        self.vps(name)
+        return [template[0] for template in TEMPLATES]
+
+    def vps_template(self, name, template_id):
+        self.vps(name)
+        for template in TEMPLATES:
+            if str(template[0]) == template_id:
+                return {
+                    "id": template[0],
+                    "name": template[1],
+                    "distribution": template[2],
+                    "bitFormat": template[3],
+                    "locale": "en",
+                    "availableLanguage": ["en", "fr"],
+                }
+        raise NotFound(template_id)
+
+    def server(self, name):
+        i = self.index(name, 'ns', self.size // 2)
+        return {
+            "name": name,
+            "serverId": i,
+            "ip": '172.{}.{}.{}'.format(16 + (i >> 16 & 15), i >> 8 & 255, i & 255),
+            "reverse": name + '.',
+            "datacenter": ["rbx1", "gra2", "sbg3", "bhs1"][i % 4],
+            "os": ["debian8_64", "centos7_64", "ubuntu1604-server_64"][i % 3],
+            "state": "ok",
+            "monitoring": True,
+            "professionalUse": False,
+            "commercialRange": "sp-32",
+            "rootDevice": None,
+            "rescueMail": None,
+            "supportLevel": "pro",
+            "bootId": 1,
+            "linkSpeed": 1000,
+            "rack": "R{}".format(i % 40),
+        }
+
+    def server_ips(self, name):
+        server = self.server(name)
+        return [server["ip"] + '/32', '2001:db8:1:{:x}::/64'.format(server["serverId"])]
+
+    def blocks(self, service=None):
+        """ IP blocks of the account, as listed by /ip, or only those routed to service """
+        if service is not None:
+            if service in self.vps_names():
+                return [ip + ('/128' if ':' in ip else '/32') for ip in self.vps_ips(service)]
+            if service in self.server_names():
+                return self.server_ips(service)
+            return []
+        blocks = []
+        for name in self.vps_names():
+            blocks.extend(ip + ('/128' if ':' in ip else '/32') for ip in self.vps_ips(name))
+        for name in self.server_names():
+            blocks.extend(self.server_ips(name))
+        return blocks
+
+    def block(self, block):
+        """ Details of an IP block, routed to the service it was generated for """
+        patterns = [
+            (r'^10\.(\d+)\.(\d+)\.(\d+)/32$', 'vps', lambda m: int(m[0]) << 16 | int(m[1]) << 8 | int(m[2])),
+            (r'^2001:db8:([0-9a-f]+)::1/128$', 'vps', lambda m: int(m[0], 16)),
+            (r'^172\.(\d+)\.(\d+)\.(\d+)/32$', 'dedicated', lambda m: (int(m[0]) - 16) << 16 | int(m[1]) << 8 | int(m[2])),
+            (r'^2001:db8:1:([0-9a-f]+)::/64$', 'dedicated', lambda m: int(m[0], 16)),
+        ]
+        for pattern, type, index in patterns:
+            match = re.match(pattern, block)
+            if match:
+                i = index(match.groups())
+                name = 'vps{}.bench'.format(i) if type == 'vps' else 'ns{}.bench'.format(i)
+                blocks = [ip + ('/128' if ':' in ip else '/32') for ip in self.vps_ips(name)] \
+                    if type == 'vps' else self.server_ips(name)
+                if block in blocks:
+                    return {"ip": block, "type": type, "routedTo": {"serviceName": name},
+                            "description": None, "canBeTerminated": False}
+        raise NotFound(block)
+
+    def projects(self):
+        return ['project{}'.format(p) for p in range(CLOUD_PROJECTS)] if self.cloud else []
+
+    def project(self, project):
+        if project not in self.projects():
+            raise NotFound(project)
+        return {"project_id": project, "description": "bench {}".format(project), "status": "ok"}
+
+    def instances(self, project):
+        """ Instances of a project, full records as /cloud/project/{id}/instance lists them """
+        self.project(project)
+        p = int(project[len('project'):])
+        instances = []
+        for i in range(p, self.cloud, CLOUD_PROJECTS):
+            instances.append({
+                "id": "{:08x}-0000-4000-8000-{:012x}".format(i, i),
+                "name": "instance{}.bench".format(i),
+                "ipAddresses": [
+                    {"ip": "198.{}.{}.{}".format(18 + (i >> 16 & 1), i >> 8 & 255, i & 255),
+                     "type": "public", "version": 4, "networkId": "", "gatewayIp": None},
+                    {"ip": "2001:db8:2:{:x}::1".format(i), "type": "public", "version": 6,
+                     "networkId": "", "gatewayIp": None},
+                ],
+                "flavorId": "flavor{}".format(i % 4),
+                "imageId": "image{}".format(i % 3),
+                "sshKeyId": None,
+                "created": "2016-01-01T00:00:00Z",
+                "region": ["GRA1", "SBG1", "BHS1"][i % 3],
+                "monthlyBilling": None,
+                "status": "ACTIVE",
+                "planCode": "b2-7.consumption",
+                "operationIds": [],
+            })
+        return instances
+
+    def task(self, name, action):
+        self.vps(name)
+        with self.lock:
+            task_id = len(self.tasks) + 1
+            self.tasks[task_id] = (name, action, time.time())
+            return {"id": task_id, "type": action + "Vm", "state": "todo", "progress": 0}
+
+    def task_status(self, name, task_id):
+        """ Tasks are done after task_duration seconds, and then change the VPS state """
+        with self.lock:
+            if not task_id.isdigit() or int(task_id) not in self.tasks or self.tasks[int(task_id)][0] != name:
+                raise NotFound(task_id)
+            _, action, created = self.tasks[int(task_id)]
+            elapsed = time.time() - created
+            if elapsed < self.task_duration:
+                progress = int(100 * elapsed / self.task_duration)
+                return {"id": int(task_id), "type": action + "Vm", "state": "doing", "progress": progress}
+            self.states[name] = "stopped" if action == "stop" else "running"
+            return {"id": int(task_id), "type": action + "Vm", "state": "done", "progress": 100}
+
+    def get(self, parts, query=None):
+        if parts == ['auth', 'time']:
+            return int(time.time())
+        if parts == ['vps']:
+            return self.vps_names()
+        if parts[:1] == ['vps'] and len(parts) == 2:
+            return self.vps(parts[1])
+        if parts[:1] == ['vps'] and parts[2:] == ['ips']:
+            return self.vps_ips(parts[1])
+        if parts[:1] == ['vps'] and len(parts) == 4 and parts[2] == 'tasks':
+            return self.task_status(parts[1], parts[3])
+        if parts[:1] == ['vps'] and len(parts) == 4 and parts[2] == 'ips':
+            return self.vps_ip(parts[1], parts[3])
+        if parts[:1] == ['vps'] and parts[2:] == ['templates']:
+            return self.vps_templates(parts[1])
+        if parts[:1] == ['vps'] and len(parts) == 4 and parts[2] == 'templates':
+            return self.vps_template(parts[1], parts[3])
+        if parts == ['dedicated', 'server']:
+            return self.server_names()
+        if parts[:2] == ['dedicated', 'server'] and len(parts) == 3:
+            return self.server(parts[2])
+        if parts[:2] == ['dedicated', 'server'] and parts[3:] == ['ips']:
+            return self.server_ips(parts[2])
+        if parts == ['cloud', 'project']:
+            return self.projects()
+        if parts[:2] == ['cloud', 'project'] and len(parts) == 3:
+            return self.project(parts[2])
+        if parts[:2] == ['cloud', 'project'] and parts[3:] == ['instance']:
+            return self.instances(parts[2])
+        if parts == ['ip']:
+            return self.blocks((query or {}).get('routedTo.serviceName', [None])[0])
+        if parts[:1] == ['ip'] and len(parts) == 2:
+            return self.block(unquote(parts[1]))
+        if parts == ['me', 'sshKey']:
+            with self.lock:
+                return sorted(self.keys)
+        if parts[:2] == ['me', 'sshKey'] and len(parts) == 3:
+            with self.lock:
+                if parts[2] not in self.keys:
+                    raise NotFound(parts[2])
+                return dict(self.keys[parts[2]])
+        raise NotFound('/'.join(parts))
+
+    def change(self, method, parts, body):
+        if method == 'POST' and parts[:1] == ['vps'] and len(parts) == 3 and \
+                parts[2] in ('reboot', 'start', 'stop', 'reinstall'):
+            return self.task(parts[1], parts[2])
+        with self.lock:
+            if method == 'POST' and parts == ['me', 'sshKey']:
+                self.keys[body["keyName"]] = {"keyName": body["keyName"], "key": body["key"], "default": False}
+                return None
+            if parts[:2] == ['me', 'sshKey'] and len(parts) == 3 and parts[2] in self.keys:
+                if method == 'PUT':
+                    self.keys[parts[2]]["default"] = bool(body.get("default"))
+                    return None
+                if method == 'DELETE':
+                    del self.keys[parts[2]]
+                    return None
+        raise NotFound('/'.join(parts))
+
+
+# path segments kept as is in endpoint templates, the others are names, ids or IPs
+LITERALS = set(['auth', 'time', 'vps', 'ips', 'ip', 'dedicated', 'server', 'me', 'sshKey', 'cloud', 'project', 'instance',
+                'reboot', 'start', 'stop', 'reinstall', 'tasks', 'templates'])
+
+
+def template(parts):
+    """ Endpoint template of a path, as counted in /_stats """
+    return '/' + '/'.join(part if part in LITERALS else '{}' for part in parts)
+
+
+class MockApi(ThreadingMixIn, HTTPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self, address, fleet, latency=0.0, throttle=0.0, seed=42):
+        HTTPServer.__init__(self, address, Handler)
+        self.fleet = Fleet(fleet)
+        self.latency = latency
+        self.throttle = throttle
+        self.random = random.Random(seed)
+        self.counts = dict()
+        self.lock = threading.Lock()
+
+    @property
+    def url(self):
+        return 'http://{0}:{1}{2}'.format(self.server_address[0], self.server_address[1], API_PREFIX)
+
+    def count(self, name):
+        with self.lock:
+            self.counts[name] = self.counts.get(name, 0) + 1
+
+    def throttled(self):
+        with self.lock:
+            return self.random.random() < self.throttle
+
+    def start(self):
+        """ Serves from a background thread """
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+        return self
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def reply(self, status, data):
+        body = json.dumps(data).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def body(self):
+        length = int(self.headers.get('Content-Length') or 0)
+        if not length:
+            return dict()
+        return json.loads(self.rfile.read(length).decode('utf-8'))
+
+    def control(self, method):
+        server = self.server
+        if self.path == '/_stats' and method == 'GET':
+            with server.lock:
+                return self.reply(200, dict(server.counts))
+        if self.path == '/_stats' and method == 'DELETE':
+            with server.lock:
+                server.counts = dict()
+            return self.reply(200, None)
+        if self.path == '/_control' and method == 'POST':
+            settings = self.body()
+            if 'fleet' in settings:
+                server.fleet.size = int(settings['fleet'])
+            if 'latency' in settings:
+                server.latency = float(settings['latency'])
+            if 'throttle' in settings:
+                server.throttle = float(settings['throttle'])
+            if 'task_duration' in settings:
+                server.fleet.task_duration = float(settings['task_duration'])
+            if 'cloud' in settings:
+                server.fleet.cloud = int(settings['cloud'])
+            return self.reply(200, None)
+        return self.reply(404, {"message": "unknown control endpoint"})
+
+    def handle_method(self, method):
+        if not self.path.startswith(API_PREFIX + '/'):
+            return self.control(method)
+        url = urlparse(self.path[len(API_PREFIX):])
+        parts = [part for part in url.path.split('/') if part]
+        batch = '$batch' in parse_qs(url.query)
+        name = method + ' ' + template(parts) + ('?$batch=,' if batch else '')
+        body = self.body() if method in ('POST', 'PUT') else dict()
+        self.server.count(name)
+
+        if self.server.latency:
+            time.sleep(self.server.latency)
+        if self.server.throttled():
+            self.server.count('429')
+            return self.reply(429, {"message": "Too many requests"})
+
+        fleet = self.server.fleet
+        try:
+            if method != 'GET':
+                return self.reply(200, fleet.change(method, parts, body))
+            if not batch:
+                return self.reply(200, fleet.get(parts, parse_qs(url.query)))
+            for i, part in enumerate(parts):
+                if ',' in part:
+                    break
+            items = []
+            for key in parts[i].split(','):
+                try:
+                    items.append({"key": key, "value": fleet.get(parts[:i] + [key] + parts[i + 1:]), "error": None})
+                except NotFound as e:
+                    items.append({"key": key, "value": None, "error": "The requested object ({}) does not exist".format(e)})
+            return self.reply(200, items)
+        except NotFound as e:
+            return self.reply(404, {"message": "The requested object ({}) does not exist".format(e)})
+
+    def do_GET(self):
+        self.handle_method('GET')
+
+    def do_POST(self):
+        self.handle_method('POST')
+
+    def do_PUT(self):
+        self.handle_method('PUT')
+
+    def do_DELETE(self):
+        self.handle_method('DELETE')
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Local stand-in for the OVH API')
+    parser.add_argument('--port', type=int, default=8080, help='Port to listen on (default: 8080)')
+    parser.add_argument('--fleet', type=int, default=100, help='Number of services (default: 100)')
+    parser.add_argument('--latency', type=float, default=0.0, help='Seconds added to every answer (default: 0)')
+    parser.add_argument('--throttle', type=float, default=0.0, help='Rate of 429 answers, 0 to 1 (default: 0)')
+    args = parser.parse_args()
+
+    server = MockApi(('127.0.0.1', args.port), args.fleet, args.latency, args.throttle)
+    print("serving {0} services on {1}".format(args.fleet, server.url))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,265 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Offline benchmarks of the inventory and the modules, against bench/mock_api.py
+#
+# For each fleet size, runs inventory/ovh.py with a cold cache, a warm cache,
+# an expired cache (incremental refresh), and --host for a cached and for an
+# uncached host. The modules are run through ansible when it is installed.
+# Reports wall time, API requests and peak memory of every run, and compares
+# them with the saved baseline: more requests, or time/memory above the
+# tolerance, are regressions and make the run fail.
+#
+# Usage: bench/run.py [--fleet 10,1000] [--latency 0.005] [--throttle 0]
+#                     [--python python] [--save-baseline] [--tolerance 0.25]
+#
+# The inventory runs with --python, which needs the ovh package, as ansible
+# would run it.
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+try:
+    from urllib2 import Request, urlopen
+except ImportError:
+    from urllib.request import Request, urlopen
+
+sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+from mock_api import MockApi
+
+ROOT = os.path.normpath(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..'))
+INVENTORY = os.path.join(ROOT, 'inventory', 'ovh.py')
+BASELINE = os.path.join(ROOT, 'bench', 'baseline.json')
+
+INI = """[ovh]
+regions = {url}
+cache_path = {cache_path}
+cache_max_age = 600
+hostname = servicename
+group_by = region, type
+"""
+
+
+class Bench(object):
+
+    def __init__(self, args):
+        self.args = args
+        self.api = MockApi(('127.0.0.1', 0), 0, args.latency, args.throttle).start()
+        self.workdir = tempfile.mkdtemp(prefix='ansible-ovh-bench')
+        self.cache_path = os.path.join(self.workdir, 'cache')
+        self.env = dict(os.environ)
+        self.env.update({
+            "OVH_INI_PATH": os.path.join(self.workdir, 'ovh.ini'),
+            "OVH_ENDPOINT": self.api.url,
+            "OVH_APPLICATION_KEY": "bench",
+            "OVH_APPLICATION_SECRET": "bench",
+            "OVH_CONSUMER_KEY": "bench",
+            "ANSIBLE_LIBRARY": os.path.join(ROOT, 'library'),
+            "ANSIBLE_MODULE_UTILS": os.path.join(ROOT, 'module_utils'),
+            # the modules read the objects the inventory fetched
+            "OVH_OBJECT_CACHE": os.path.join(self.workdir, 'cache', 'ansible-ovh-{}.objects'.format(os.getuid())),
+        })
+        with open(self.env["OVH_INI_PATH"], 'w') as f:
+            f.write(INI.format(url=self.api.url, cache_path=self.cache_path))
+        # IPs resolved from /ip
+        self.account_ini = os.path.join(self.workdir, 'account.ini')
+        with open(self.account_ini, 'w') as f:
+            f.write(INI.format(url=self.api.url, cache_path=self.cache_path) + "ip_source = account\n")
+        self.results = []
+
+    def control(self, method, path, data=None):
+        url = self.api.url.rsplit('/', 1)[0] + path
+        body = json.dumps(data).encode('utf-8') if data is not None else None
+        request = Request(url, body, {'Content-Type': 'application/json'})
+        request.get_method = lambda: method
+        return json.loads(urlopen(request).read().decode('utf-8'))
+
+    def run(self, scenario, fleet, command, env=None):
+        """ Runs command, recording its wall time, API requests and peak memory """
+        self.control('DELETE', '/_stats')
+        with open(os.devnull, 'wb') as devnull:
+            start = time.time()
+            process = subprocess.Popen(command, env=dict(self.env, **(env or {})), stdout=devnull)
+            _, status, usage = os.wait4(process.pid, 0)
+            wall = time.time() - start
+        if status != 0:
+            raise RuntimeError("{0} failed: {1}".format(' '.join(command), status))
+        counts = self.control('GET', '/_stats')
+        throttled = counts.pop('429', 0)
+        result = {
+            "scenario": scenario,
+            "fleet": fleet,
+            "wall": round(wall, 3),
+            "requests": sum(counts.values()),
+            "throttled": throttled,
+            # kilobytes on linux
+            "maxrss": usage.ru_maxrss,
+        }
+        self.results.append(result)
+        return result
+
+    def inventory(self, *args):
+        return [self.args.python, INVENTORY] + list(args)
+
+    def module(self, name, module_args):
+        return ['ansible', 'localhost', '-c', 'local', '-m', name, '-a', module_args,
+                '-e', 'ansible_python_interpreter={}'.format(self.args.python)]
+
+    def clear(self):
+        if os.path.isdir(self.cache_path):
+            shutil.rmtree(self.cache_path)
+        os.makedirs(self.cache_path)
+
+    def fleet(self, size):
+        self.control('POST', '/_control', {"fleet": size})
+        self.clear()
+        self.run('inventory cold ip_source=account', size, self.inventory('--list'),
+                 {"OVH_INI_PATH": self.account_ini})
+        self.clear()
+
+        self.run('inventory cold', size, self.inventory('--list'))
+        self.run('inventory warm', size, self.inventory('--list'))
+        self.run('inventory warm --pretty', size, self.inventory('--list', '--pretty'))
+        self.run('inventory --host hit', size, self.inventory('--host', 'vps0.bench'))
+
+        # two more services, a vps the cache doesn't know about
+        self.control('POST', '/_control', {"fleet": size + 2})
+        self.run('inventory --host miss', size, self.inventory('--host', 'vps{}.bench'.format(size - size // 2)))
+
+        cache = os.path.join(self.cache_path, 'ansible-ovh.cache')
+        expired = time.time() - 3600
+        os.utime(cache, (expired, expired))
+        self.run('inventory expired', size, self.inventory('--list'))
+        self.control('POST', '/_control', {"fleet": size})
+
+        # VPS only, the dedicated servers are not fetched
+        self.clear()
+        self.run('inventory cold --type vps', size, self.inventory('--list', '--type', 'vps'))
+
+        # as many cloud instances as services
+        self.control('POST', '/_control', {"cloud": size})
+        self.clear()
+        self.run('inventory cold with cloud', size, self.inventory('--list'))
+        self.control('POST', '/_control', {"cloud": 0})
+
+    def modules(self):
+        key = os.path.join(self.workdir, 'bench.pub')
+        with open(key, 'w') as f:
+            f.write('ssh-rsa AAAAB3NzaC1yc2EAAAADAQABAAABAQC bench@localhost\n')
+        self.run('ovh_vps reboot', None, self.module('ovh_vps', 'name=vps0.bench action=reboot'))
+        # every VPS of the last fleet in a single run
+        self.run('ovh_vps reboot bulk', None, self.module('ovh_vps', 'name=vps*.bench action=reboot concurrency=20'))
+        # templates resolved once per VPS model, then from the object cache
+        reinstall = 'action=reinstall template=debian9 ssh_key=bench concurrency=20'
+        self.run('ovh_vps reinstall bulk by name', None, self.module('ovh_vps', 'name=vps*.bench ' + reinstall))
+        self.run('ovh_vps reinstall by name', None, self.module('ovh_vps', 'name=vps0.bench ' + reinstall))
+        # tasks lasting a few seconds, as the polling backoff matters
+        self.control('POST', '/_control', {"task_duration": 3})
+        self.run('ovh_vps stop wait', None, self.module('ovh_vps', 'name=vps0.bench action=stop wait=yes'))
+        self.run('ovh_vps start wait', None, self.module('ovh_vps', 'name=vps0.bench action=start wait=yes'))
+        self.control('POST', '/_control', {"task_duration": 0})
+        self.run('ovh_ssh present', None, self.module('ovh_ssh', 'name=bench path={}'.format(key)))
+        team = []
+        for i in range(40):
+            team.append(os.path.join(self.workdir, 'team{}.pub'.format(i)))
+            with open(team[-1], 'w') as f:
+                f.write('ssh-ed25519 AAAAC3NzaC1lZDI1NTE5{0} user{0}@localhost\n'.format(i))
+        sync = 'exclusive=yes keys={}'.format(','.join(team))
+        self.run('ovh_ssh sync 40 keys', None, self.module('ovh_ssh', sync))
+        self.run('ovh_ssh sync unchanged', None, self.module('ovh_ssh', sync))
+
+    def close(self):
+        self.api.shutdown()
+        shutil.rmtree(self.workdir)
+
+
+def which(command):
+    return any(os.access(os.path.join(path, command), os.X_OK) for path in os.environ["PATH"].split(os.pathsep))
+
+
+def key(result):
+    if result["fleet"] is None:
+        return result["scenario"]
+    return "{0} @{1}".format(result["scenario"], result["fleet"])
+
+
+def compare(result, baseline, tolerance):
+    """ Regressions of result against its baseline, as text """
+    regressions = []
+    if result["requests"] > baseline["requests"]:
+        regressions.append("requests {0} > {1}".format(result["requests"], baseline["requests"]))
+    # a small absolute slack, short runs are noisy
+    if result["wall"] > baseline["wall"] * (1 + tolerance) + 0.05:
+        regressions.append("wall {0:.3f}s > {1:.3f}s".format(result["wall"], baseline["wall"]))
+    if result["maxrss"] > baseline["maxrss"] * (1 + tolerance):
+        regressions.append("maxrss {0} > {1}".format(result["maxrss"], baseline["maxrss"]))
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the inventory and modules against a local mock API')
+    parser.add_argument('--fleet', default='10,1000',
+                        help='Comma separated fleet sizes, in services (default: 10,1000)')
+    parser.add_argument('--latency', type=float, default=0.005,
+                        help='Seconds added by the mock API to every answer (default: 0.005)')
+    parser.add_argument('--throttle', type=float, default=0.0,
+                        help='Rate of 429 answers of the mock API, 0 to 1 (default: 0)')
+    parser.add_argument('--python', default='python', help='Interpreter running the inventory and modules')
+    parser.add_argument('--no-modules', action='store_true', help='Skip the module benchmarks')
+    parser.add_argument('--baseline', default=BASELINE, help='Baseline file (default: bench/baseline.json)')
+    parser.add_argument('--save-baseline', action='store_true', help='Save the results as the new baseline')
+    parser.add_argument('--tolerance', type=float, default=0.25,
+                        help='Allowed time and memory increase over the baseline (default: 0.25)')
+    args = parser.parse_args()
+
+    bench = Bench(args)
+    try:
+        for size in [int(size) for size in args.fleet.split(',')]:
+            bench.fleet(size)
+        if not args.no_modules:
+            if which('ansible'):
+                bench.modules()
+            else:
+                print("ansible not found, module benchmarks skipped")
+    finally:
+        bench.close()
+
+    baseline = dict()
+    if os.path.isfile(args.baseline):
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+
+    failed = False
+    print("{0:<40} {1:>9} {2:>9} {3:>9} {4:>11}  {5}".format(
+        "scenario", "wall (s)", "requests", "throttled", "maxrss (kB)", "vs baseline"))
+    for result in bench.results:
+        name = key(result)
+        if name in baseline:
+            regressions = compare(result, baseline[name], args.tolerance)
+            verdict = "REGRESSION: " + ", ".join(regressions) if regressions else "ok"
+            failed = failed or bool(regressions)
+        else:
+            verdict = "no baseline"
+        print("{0:<40} {1:>9.3f} {2:>9} {3:>9} {4:>11}  {5}".format(
+            name, result["wall"], result["requests"], result["throttled"], result["maxrss"], verdict))
+
+    if args.save_baseline:
+        baseline.update((key(result), result) for result in bench.results)
+        with open(args.baseline, 'w') as f:
+            json.dump(baseline, f, sort_keys=True, indent=2)
+            f.write('\n')
+        print("baseline saved to {}".format(args.baseline))
+        return 0
+    return 1 if failed else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+#
+# Startup time of inventory/ovh.py when its cache is warm
+#
+# The first run warms the cache if needed (it may call the API), the timed
+# runs must then all be answered from the cache. Exits non zero when the
+# median run is slower than the target.
+#
+# Usage: bench/startup.py [--runs 50] [--target-ms 50] [--host name]
+#        OVH_INI_PATH selects another ovh.ini, as for the inventory itself
+
+from __future__ import print_function
+
+import argparse
+import os
+import subprocess
+import sys
+import time
+
+INVENTORY = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'inventory', 'ovh.py')
+
+
+def run(args):
+    """ Runs the inventory once, returns its wall time in seconds """
+    command = [INVENTORY] if os.access(INVENTORY, os.X_OK) else ['python', INVENTORY]
+    with open(os.devnull, 'wb') as devnull:
+        start = time.time()
+        subprocess.check_call(command + args, stdout=devnull)
+        return time.time() - start
+
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Time inventory/ovh.py runs served from a warm cache')
+    parser.add_argument('--runs', type=int, default=50, help='Number of timed runs (default: 50)')
+    parser.add_argument('--target-ms', type=float, default=50.0,
+                        help='Maximum median run time in milliseconds (default: 50)')
+    parser.add_argument('--host', help='Time --host lookups of this host instead of --list')
+    args = parser.parse_args()
+
+    inventory_args = ['--host', args.host] if args.host else ['--list']
+    warmup = run(inventory_args)
+    timings = [run(inventory_args) for _ in range(args.runs)]
+
+    median = percentile(timings, 50) * 1000
+    print("{0}: warm-up {1:.1f} ms, {2} runs: min {3:.1f} ms, p50 {4:.1f} ms, p95 {5:.1f} ms, max {6:.1f} ms".format(
+        ' '.join(inventory_args), warmup * 1000, args.runs, min(timings) * 1000, median,
+        percentile(timings, 95) * 1000, max(timings) * 1000))
+    if median > args.target_ms:
+        print("FAIL: p50 {0:.1f} ms is above the {1:.1f} ms target".format(median, args.target_ms))
+        return 1
+    print("OK: p50 is within the {0:.1f} ms target".format(args.target_ms))
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
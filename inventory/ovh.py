@@ -20,39 +20,39 @@
 # along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
 
 
+# Only what a run served from a fresh cache needs is imported here,
+# the API stack is imported after the fast path below.
 import sys
-import argparse
 import re
 import os
 import ConfigParser
-from time import time
+import errno
+import fcntl
+import mmap
+import stat
+import struct
+import tempfile
+import zlib
+from time import time, sleep
 
 try:
     import json
 except ImportError:
     import simplejson as json
 
-# Avoid to load ourself - Doesn't work with symlinks
-for path in [os.getcwd(), '', os.path.dirname(os.path.abspath(__file__))]:
-    try:
-        del sys.path[sys.path.index(path)]
-    except:
-        pass
-
-try:
-    import ovh
-except ImportError:
-    print "failed=True msg='ovh required for this software'"
-    sys.exit(1)
+# environment variables of the --region, --type, --group and --hosts filters
+FILTER_ENV = {
+    "region": "OVH_INVENTORY_REGION",
+    "type": "OVH_INVENTORY_TYPE",
+    "group": "OVH_INVENTORY_GROUP",
+    "hosts": "OVH_INVENTORY_HOSTS",
+}
 
-try:
-    import ipaddress
-except ImportError:
-    print "failed=True msg='py2-ipaddress required for this software'"
-    sys.exit(1)
+def warn(msg):
+    sys.stderr.write("ovh inventory: {}\n".format(msg))
 
-def removeKey(d, key):
-    if key in d: del d[key]
+def isFailure(value):
+    return isinstance(value, Exception)
 
 def cleanUpHost(d):
     for k in d:
@@ -78,73 +78,675 @@ removeArgsServer = [
     "supportLevel",
     "bootId"
 ]
-class OvhInventory(object):
+def atomicWrite(filename, chunks):
+    """ Writes chunks to a temporary file renamed over filename, readers never see a partial file """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+                               prefix='.' + os.path.basename(filename))
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            for chunk in chunks:
+                f.write(chunk)
+        umask = os.umask(0)
+        os.umask(umask)
+        os.chmod(tmp, 0o666 & ~umask)
+        os.rename(tmp, filename)
+    except:
+        os.unlink(tmp)
+        raise
 
-    def __init__(self):
 
-        """ Main execution path """
-        self.conn = None
+class JsonCacheBackend(object):
+    """ Stores cache files as compact JSON.
+
+        Files start with a header line naming the backend. Record files hold one
+        encoded value per key, followed by an index of their offsets and a trailer
+        giving the index position, so a single record is read without decoding
+        the others """
+
+    name = 'json'
+    trailer = struct.Struct('>QQ')
+
+    def header(self):
+        return 'ansible-ovh {}\n'.format(self.name)
+
+    def encode(self, data):
+        return json.dumps(data, sort_keys=True, separators=(',', ':'))
+
+    def decode(self, raw):
+        return json.loads(raw)
+
+    def is_readable(self, filename):
+        """ True if filename exists and was written by this backend """
+        try:
+            with open(filename, 'rb') as f:
+                return f.readline() == self.header()
+        except IOError:
+            return False
+
+    def write(self, filename, data):
+        atomicWrite(filename, [self.header(), self.encode(data)])
+
+    def read(self, filename):
+        with open(filename, 'rb') as f:
+            if f.readline() != self.header():
+                raise ValueError("{} was not written by the {} cache backend".format(filename, self.name))
+            return self.decode(f.read())
+
+    def write_records(self, filename, records):
+        """ Writes (key, value) pairs as separately decodable records """
+        def chunks():
+            index = dict()
+            offset = 0
+            head = self.header()
+            yield head
+            offset += len(head)
+            for key, value in records:
+                raw = self.encode(value)
+                index[key] = [offset, len(raw)]
+                offset += len(raw)
+                yield raw
+            raw = self.encode(index)
+            yield raw
+            yield self.trailer.pack(offset, len(raw))
+        atomicWrite(filename, chunks())
+
+    def _map(self, f):
+        mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        head = self.header()
+        if mm[:len(head)] != head or len(mm) < len(head) + self.trailer.size:
+            mm.close()
+            raise ValueError("{} was not written by the {} cache backend".format(f.name, self.name))
+        offset, length = self.trailer.unpack(mm[-self.trailer.size:])
+        return mm, self.decode(mm[offset:offset + length])
+
+    def read_record(self, filename, key):
+        """ Decodes the record of key only, None if there is none """
+        with open(filename, 'rb') as f:
+            mm, index = self._map(f)
+            try:
+                if key not in index:
+                    return None
+                offset, length = index[key]
+                return self.decode(mm[offset:offset + length])
+            finally:
+                mm.close()
+
+    def read_records(self, filename):
+        """ Yields the (key, value) pairs of a record file in written order """
+        with open(filename, 'rb') as f:
+            mm, index = self._map(f)
+            try:
+                for key, (offset, length) in sorted(index.items(), key=lambda item: item[1][0]):
+                    yield key, self.decode(mm[offset:offset + length])
+            finally:
+                mm.close()
+
+
+class ZlibCacheBackend(JsonCacheBackend):
+    """ Stores cache files as zlib compressed JSON, each record compressed on its own """
+
+    name = 'zlib'
+
+    def encode(self, data):
+        return zlib.compress(JsonCacheBackend.encode(self, data))
+
+    def decode(self, raw):
+        return JsonCacheBackend.decode(self, zlib.decompress(raw))
+
+
+CACHE_BACKENDS = dict((backend.name, backend) for backend in [JsonCacheBackend, ZlibCacheBackend])
+
+def listChunks(groups, hosts, pretty=False):
+    """ Yields the --list JSON piece by piece: the groups, then the hostvars of hosts,
+        an iterable of (host, hostvars), each encoded on its own so neither a merged
+        dict nor the whole string is ever built. Compact unless pretty """
+    if pretty:
+        newline, indent, colon = '\n', '  ', ': '
+        def encode(data, depth):
+            return json.dumps(data, sort_keys=True, indent=2, separators=(',', ': ')).replace('\n', '\n' + indent * depth)
+    else:
+        newline, indent, colon = '', '', ':'
+        def encode(data, depth):
+            return json.dumps(data, sort_keys=True, separators=(',', ':'))
+    yield '{'
+    for group in sorted(groups):
+        yield newline + indent + json.dumps(group) + colon + encode(groups[group], 1) + ','
+    yield newline + indent + '"_meta"' + colon + '{' + newline + indent * 2 + '"hostvars"' + colon + '{'
+    separator = ''
+    for host, hostvars in hosts:
+        yield separator + newline + indent * 3 + json.dumps(host) + colon + encode(hostvars, 3)
+        separator = ','
+    yield newline + indent * 2 + '}' + newline + indent + '}' + newline + '}\n'
+
+def writeChunks(chunks, out=sys.stdout):
+    for chunk in chunks:
+        out.write(chunk)
+
+class TrackedOutput(object):
+    """ A stream remembering whether anything was written to it """
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.written = False
+
+    def write(self, data):
+        self.written = self.written or bool(data)
+        self.stream.write(data)
+
+class RefreshLock(object):
+    """ Exclusive lock on a file, held while the cache is written so concurrent
+        runs do a single refresh: the others wait for it, then read its result """
+
+    def __init__(self, filename, timeout):
+        self.filename = filename
+        self.timeout = timeout
+        self.fd = None
+
+    def acquire(self, blocking=True):
+        """ Waits up to timeout seconds for the lock, returns False if it wasn't acquired """
+        self.fd = os.open(self.filename, os.O_RDWR | os.O_CREAT, 0o666)
+        deadline = time() + self.timeout
+        while True:
+            try:
+                fcntl.flock(self.fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return True
+            except IOError as e:
+                if e.errno not in (errno.EAGAIN, errno.EACCES):
+                    raise
+            if not blocking or time() >= deadline:
+                os.close(self.fd)
+                self.fd = None
+                return False
+            sleep(0.1)
+
+    def release(self):
+        if self.fd is not None:
+            fcntl.flock(self.fd, fcntl.LOCK_UN)
+            os.close(self.fd)
+            self.fd = None
+
+    def __enter__(self):
+        if not self.acquire():
+            warn("no lock on {0} after {1}s, going on without it".format(self.filename, self.timeout))
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+def readConfig():
+    """ Reads ovh.ini, next to this script unless OVH_INI_PATH is set """
+    config = ConfigParser.SafeConfigParser()
+    default_path = os.path.dirname(os.path.realpath(__file__)) + '/ovh.ini'
+    config.read(os.environ.get('OVH_INI_PATH', default_path))
+    return config
+
+def getCacheSettings(config):
+    """ Cache files, max age and backend from the ovh.ini settings """
+    cache_path = config.get('ovh', 'cache_path')
+    cache_format = 'json'
+    if config.has_option('ovh', 'cache_format'):
+        cache_format = config.get('ovh', 'cache_format')
+    if cache_format not in CACHE_BACKENDS:
+        raise ValueError("cache_format must be one of {}".format(", ".join(sorted(CACHE_BACKENDS))))
+    return {
+        "cache_path_cache": cache_path + "/ansible-ovh.cache",
+        "cache_path_inventory": cache_path + "/ansible-ovh.index",
+        "cache_path_state": cache_path + "/ansible-ovh.state",
+        "cache_path_list": cache_path + "/ansible-ovh.list",
+        "cache_path_lock": cache_path + "/ansible-ovh.lock",
+        "cache_path_socket": cache_path + "/ansible-ovh.sock",
+        # TIME_DELTA_CACHE_NAME of ovh_api
+        "cache_path_time": cache_path + "/ansible-ovh-{}.time".format(os.getuid()),
+        # OBJECT_CACHE_NAME of ovh_api, not loaded by the fast path
+        "cache_path_objects": cache_path + "/ansible-ovh-{}.objects".format(os.getuid()),
+        "cache_path_history": cache_path + "/ansible-ovh.history",
+        "cache_path_config": cache_path + "/ansible-ovh.ini",
+        "cache_max_age": config.getint('ovh', 'cache_max_age'),
+        "cache_stale_grace": getInt(config, 'cache_stale_grace', 0),
+        "refresh_lock_timeout": getInt(config, 'refresh_lock_timeout', 300),
+        "backend": CACHE_BACKENDS[cache_format](),
+    }
+
+def getInt(config, option, default):
+    if config.has_option('ovh', option):
+        return config.getint('ovh', option)
+    return default
+
+def getList(config, option):
+    """ Comma separated option as a list, None when not set """
+    if config.has_option('ovh', option):
+        return splitList(config.get('ovh', option))
+    return None
+
+def splitList(value):
+    """ Items of a comma separated value, None when value is None """
+    if value is None:
+        return None
+    return [item for item in re.sub(r'\s+', '', value).split(',') if item]
+
+def isCacheValid(settings, grace=0):
+    """ Determines if the cache files have expired, or if it is still valid.
+        grace extends cache_max_age, to accept a stale cache """
+    if settings["backend"].is_readable(settings["cache_path_cache"]):
+        mod_time = os.path.getmtime(settings["cache_path_cache"])
+        if (mod_time + settings["cache_max_age"] + grace) > time():
+            if os.path.isfile(settings["cache_path_inventory"]):
+                return True
+    return False
+
+def spawnBackgroundRefresh(settings):
+    """ Starts a detached run refreshing the cache, unless a refresh is already running """
+    lock = RefreshLock(settings["cache_path_lock"], 0)
+    if not lock.acquire(blocking=False):
+        return
+    lock.release()
+    # only needed with a stale cache
+    import subprocess
+    env = None
+    if settings.get("config") is not None:
+        # settings not read from ovh.ini (the inventory plugin options), given to the run as a copy
+        from StringIO import StringIO
+        text = StringIO()
+        settings["config"].write(text)
+        atomicWrite(settings["cache_path_config"], [text.getvalue()])
+        env = dict(os.environ, OVH_INI_PATH=settings["cache_path_config"])
+    with open(os.devnull, 'r+b') as devnull:
+        subprocess.Popen([sys.executable, os.path.realpath(__file__), '--background-refresh'],
+                         stdin=devnull, stdout=devnull, stderr=devnull, env=env,
+                         close_fds=True, preexec_fn=os.setsid)
+
+# seconds a daemon answer may stall, the cache files are read instead when nothing was received
+DAEMON_TIMEOUT = 10
+
+def isPrivateSocket(path):
+    """ True if path is a socket (not a link) of the current user that nobody else can write to:
+        another user could otherwise serve any hostvars, such as ansible_ssh_common_args """
+    try:
+        info = os.lstat(path)
+    except OSError:
+        return False
+    return stat.S_ISSOCK(info.st_mode) and info.st_uid == os.getuid() and not info.st_mode & 0o022
+
+def queryDaemon(path, host, pretty=False, out=sys.stdout):
+    """ Streams the answer of a running daemon (see --daemon) to out,
+        returns False when there is no daemon to answer, or none to trust """
+    if not isPrivateSocket(path):
+        warn("ignoring daemon socket {}, not a socket of this user only".format(path))
+        return False
+    # only needed when a daemon runs
+    import socket
+    client = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    client.settimeout(DAEMON_TIMEOUT)
+    written = False
+    try:
+        client.connect(path)
+        if host is not None:
+            client.sendall('host {}\n'.format(host))
+        else:
+            client.sendall('list pretty\n' if pretty else 'list\n')
+        for chunk in iter(lambda: client.recv(65536), ''):
+            out.write(chunk)
+            written = True
+    except socket.error:
+        if written:
+            raise
+    finally:
+        client.close()
+    return written
+
+def fastPath(argv):
+    """ Answers --list and --host from a fresh cache, without loading argparse, the ovh
+        client or anything else only needed for a refresh. Returns False when the
+        regular path is needed: other arguments, stale cache or unknown host. A cache
+        or daemon failing once the output started exits, the regular path would
+        print a second answer after the partial one """
+    args = argv[1:]
+    pretty = '--pretty' in args
+    args = [arg for arg in args if arg != '--pretty']
+    if any(os.environ.get(variable) for variable in FILTER_ENV.values()):
+        # filtered output is built from the refresh state
+        return False
+    if args in ([], ['--list']):
+        host = None
+    elif len(args) == 2 and args[0] == '--host':
+        host = args[1]
+    else:
+        return False
+
+    out = TrackedOutput(sys.stdout)
+    try:
+        settings = getCacheSettings(readConfig())
+        if os.path.exists(settings["cache_path_socket"]) and queryDaemon(settings["cache_path_socket"], host, pretty, out):
+            return True
+        stale = not isCacheValid(settings)
+        if stale and not isCacheValid(settings, settings["cache_stale_grace"]):
+            return False
+        if host is None and pretty:
+            backend = settings["backend"]
+            writeChunks(listChunks(backend.read(settings["cache_path_inventory"]),
+                                   backend.read_records(settings["cache_path_cache"]), True), out)
+        elif host is None:
+            # the compact --list output is stored as is, stream it
+            with open(settings["cache_path_list"], 'rb') as f:
+                for chunk in iter(lambda: f.read(65536), ''):
+                    out.write(chunk)
+        else:
+            hostvars = settings["backend"].read_record(settings["cache_path_cache"], host)
+            if hostvars is None:
+                return False
+            out.write(json.dumps(hostvars, sort_keys=True, indent=2) + "\n")
+    except (ConfigParser.Error, ValueError, IOError, zlib.error) as e:
+        # socket.error is an IOError too
+        if out.written:
+            warn("output interrupted: {}".format(e))
+            sys.stdout.flush()
+            sys.exit(1)
+        return False
+    if stale:
+        # stale while revalidate
+        spawnBackgroundRefresh(settings)
+    return True
+
+if __name__ == '__main__' and fastPath(sys.argv):
+    sys.stdout.flush()
+    sys.exit(0)
+
+import argparse
+import copy
+import hashlib
+from fnmatch import fnmatchcase
+from multiprocessing.pool import ThreadPool
+from urllib import quote
+
+# Avoid to load ourself - Doesn't work with symlinks
+# (not when imported by the inventory plugin, under another name)
+for path in ([os.getcwd(), '', os.path.dirname(os.path.abspath(__file__))] if __name__ == '__main__' else []):
+    try:
+        del sys.path[sys.path.index(path)]
+    except:
+        pass
+
+try:
+    import ovh
+except ImportError:
+    print "failed=True msg='ovh required for this software'"
+    sys.exit(1)
+
+try:
+    import ipaddress
+except ImportError:
+    print "failed=True msg='py2-ipaddress required for this software'"
+    sys.exit(1)
+
+sys.path.append(os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'module_utils'))
+from ovh_api import CallStats, DEFAULT_OBJECT_TTLS, ObjectCache, OvhApi, buildClient, getChunk, parsePairs, parseRateLimits
+
+
+# seconds between the daemon checks of the cache age
+DAEMON_POLL_INTERVAL = 5
+
+
+class RefreshError(Exception):
+    """ Services that could neither be listed nor read from the cache """
+
+
+# computed_groups: group name prefix and value of a host, from its record
+COMPUTED_GROUPS = {
+    "datacenter": lambda d: d.get("datacenter") or (d.get("zone") or "").split(':')[-1].strip(),
+    "os": lambda d: d.get("os"),
+    "offer": lambda d: d.get("commercialrange") or (d.get("model") or {}).get("name") or d.get("offertype") or d.get("plancode"),
+    "state": lambda d: d.get("state") or d.get("status"),
+}
+
+# record fields whose changes make a host modified, see get_changes
+CHANGE_KEYS = ["state", "status", "primary_ip", "ips", "reverse"]
+# --changes-since values from this one on are unix times, generations below
+CHANGES_SINCE_TIME = 1000000000
+
+
+def fingerprint(d):
+    """ Short digest of the CHANGE_KEYS of a record """
+    values = dict((key, d.get(key)) for key in CHANGE_KEYS)
+    if isinstance(values["ips"], dict):
+        values["ips"] = dict((version, sorted(ips)) for version, ips in values["ips"].items())
+    return hashlib.md5(json.dumps(values, sort_keys=True)).hexdigest()[:12]
+
+
+def historyDelta(old, new):
+    """ Changes from the old to the new fingerprints of the hosts, see write_history """
+    return {
+        "changed": dict((host, value) for host, value in new.items() if old.get(host) != value),
+        "removed": sorted(host for host in old if host not in new),
+    }
+
+
+def applyDelta(hosts, delta):
+    """ Applies a historyDelta to the fingerprints hosts, in place """
+    hosts.update(delta["changed"])
+    for host in delta["removed"]:
+        hosts.pop(host, None)
+    return hosts
+
+
+class SubnetIndex(object):
+    """ Prefix tree of networks: finds the networks holding an IP in at most as
+        many steps as the longest prefix, whatever the number of networks """
+
+    def __init__(self, networks):
+        # nodes are [child for bit 0, child for bit 1, networks ending there]
+        self.roots = {4: [None, None, []], 6: [None, None, []]}
+        for network in networks:
+            network = ipaddress.ip_network(unicode(network), strict=False)
+            node = self.roots[network.version]
+            bits = int(network.network_address)
+            for i in range(network.prefixlen):
+                bit = (bits >> (network.max_prefixlen - 1 - i)) & 1
+                if node[bit] is None:
+                    node[bit] = [None, None, []]
+                node = node[bit]
+            node[2].append(network)
+
+    def lookup(self, ip):
+        """ Networks holding ip, widest first """
+        ip = ipaddress.ip_address(unicode(ip))
+        node = self.roots[ip.version]
+        bits = int(ip)
+        found = list(node[2])
+        for i in range(ip.max_prefixlen):
+            node = node[(bits >> (ip.max_prefixlen - 1 - i)) & 1]
+            if node is None:
+                break
+            found.extend(node[2])
+        return found
+
+
+class OvhInventory(object):
+
+    def __init__(self, config=None):
+        """ Settings from config, a ConfigParser with an ovh section, ovh.ini by default """
 
         self.inventory = dict()  # A list of groups and the hosts in that group
+        self.group_members = dict()  # The hosts of each group, as sets
         self.cache = dict()  # Details about hosts in the inventory
+        self.fingerprints = dict()  # fingerprint of each host, see write_history
+        self.stats = CallStats()  # API calls of all regions
+        self.ip_indexes = dict()  # IP blocks by service, per client, see account_ips
+
+        self.read_settings(config)
+
+    def run(self):
+
+        """ Main execution path """
 
-        # Read settings and parse CLI arguments
-        self.read_settings()
         self.parse_cli_args()
 
-        # Cache
-        if self.args.refresh_cache:
-            self.update_cache()
-        elif not self.is_cache_valid():
-            self.update_cache()
-        else:
-            self.load_inventory_from_cache()
-            self.load_cache_from_cache()
+        if self.args.daemon:
+            self.run_daemon()
+            return
 
-        data_to_print = ""
+        # Cache
+        if self.args.background_refresh:
+            self.refresh()
+            return
+        regions, types = self.scope()
+        refreshed = self.update(self.args.refresh_cache, regions, types)
 
         # Data to print
         if self.args.host:
-            data_to_print += self.get_host_info()
+            print(self.get_host_info())
+        elif self.args.changes_since is not None:
+            if not refreshed:
+                self.load_inventory_from_cache()
+            changes = self.get_changes(self.args.changes_since, self.args.changes_format == 'inventory')
+            print(self.json_format_dict(changes, self.args.pretty))
+        elif any(self.filters.values()):
+            if not refreshed:
+                self.load_state_from_cache()
+            self.rebuild_cache(regions, types, self.filters["hosts"])
+            if self.filters["group"]:
+                self.filter_groups(self.filters["group"])
+            writeChunks(self.list_chunks(self.args.pretty))
         else:
-            self.inventory['_meta'] = { 'hostvars': {} }
-            for hostname in self.cache:
-                self.inventory['_meta']['hostvars'][hostname] = self.cache[hostname]
-            data_to_print += self.json_format_dict(self.inventory, True)
+            if not refreshed:
+                # hosts are streamed from the cache file, never all loaded
+                self.load_inventory_from_cache()
+            writeChunks(self.list_chunks(self.args.pretty, not refreshed))
+
+        if self.args.profile:
+            self.write_profile(self.args.profile)
+
 
-        print(data_to_print)
+    def update(self, force=False, regions=None, types=None):
+        """ Refreshes the cache when forced or expired, serving a cache expired for less
+            than cache_stale_grace while a detached run refreshes it. Returns True if
+            the hosts and groups were refreshed, False if they are to be read from the cache.
+            Only regions and types are refreshed when given, when they expired """
 
+        if force or regions is not None or types is not None:
+            return self.refresh(force, regions, types)
+        if self.is_cache_valid():
+            return False
+        if self.is_cache_valid(self.cache_stale_grace):
+            spawnBackgroundRefresh(self.__dict__)
+            return False
+        return self.refresh()
+
+    def load(self, force=False):
+        """ Groups and hostvars of all hosts, refreshed as needed, see update """
+
+        if not self.update(force):
+            self.load_inventory_from_cache()
+            self.load_cache_from_cache()
+        return self.inventory, self.cache
 
-    def is_cache_valid(self):
+    def is_cache_valid(self, grace=0):
         """ Determines if the cache files have expired, or if it is still valid """
 
-        if os.path.isfile(self.cache_path_cache):
-            mod_time = os.path.getmtime(self.cache_path_cache)
-            current_time = time()
-            if (mod_time + self.cache_max_age) > current_time:
-                if os.path.isfile(self.cache_path_inventory):
-                    return True
+        return isCacheValid(self.__dict__, grace)
 
-        return False
+    def is_scope_valid(self, regions, types):
+        """ True if the types of services of regions were all refreshed less than
+            cache_max_age ago, loads the refresh state """
+
+        if not self.backend.is_readable(self.cache_path_cache):
+            return False
+        self.load_state_from_cache()
+        now = time()
+        for region in regions:
+            services = self.state["regions"].get(region, {})
+            for type in types:
+                if services.get(type, {}).get("refreshed", 0) + self.cache_max_age <= now:
+                    return False
+        return True
+
+    def refresh_lock(self):
+        return RefreshLock(self.cache_path_lock, self.refresh_lock_timeout)
+
+    def refresh(self, force=False, regions=None, types=None):
+        """ Updates the cache, once for all concurrent runs: returns False without
+            refreshing when another run did it while this one was waiting for the lock.
+            Only regions and types when given, see update_cache """
 
-    def read_settings(self):
-        """ Reads the settings from the ovh.ini file """
+        with self.refresh_lock():
+            if not force:
+                if regions is None and types is None and self.is_cache_valid():
+                    return False
+                if (regions is not None or types is not None) and \
+                        self.is_scope_valid(regions or self.regions, types or self.service_types()):
+                    return False
+            self.update_cache(force, regions, types)
+        return True
+
+    def read_settings(self, config=None):
+        """ Reads the settings from config, the ovh.ini file by default """
         pattern = re.compile(r'\s+')
-        config = ConfigParser.SafeConfigParser()
-        config.read(os.path.dirname(os.path.realpath(__file__)) + '/ovh.ini')
+        # see spawnBackgroundRefresh
+        self.config = config
+        if config is None:
+            config = readConfig()
         self.regions = []
         configRegions = re.sub(pattern, '', config.get('ovh', 'regions'))
         self.regions = configRegions.split(",")
         configGroupby = re.sub(pattern, '',config.get('ovh', 'group_by'))
         self.Groupby = configGroupby.split(",")
         self.configHostname = config.get('ovh', 'hostname')
+        self.computed_groups = getList(config, 'computed_groups') or []
+        for gb in self.computed_groups:
+            if gb not in COMPUTED_GROUPS and gb != "subnet":
+                raise ValueError("computed_groups must be among {}".format(", ".join(sorted(COMPUTED_GROUPS) + ["subnet"])))
+        self.subnets = SubnetIndex(getList(config, 'subnets') or [])
+        self.workers = 8
+        if config.has_option('ovh', 'workers'):
+            self.workers = config.getint('ovh', 'workers')
+        self.batch_size = 50
+        if config.has_option('ovh', 'batch_size'):
+            self.batch_size = max(config.getint('ovh', 'batch_size'), 1)
+        # endpoint templates that refused a batch call, not retried in batch mode
+        self.batch_unsupported = set()
+        self.rate_limits = dict()
+        if config.has_option('ovh', 'rate_limits'):
+            self.rate_limits = parseRateLimits(config.get('ovh', 'rate_limits'))
+        self.retries = getInt(config, 'retries', 3)
+        # hostvars kept: hostvars_include only, or all but hostvars_exclude,
+        # or all but removeArgsVps/removeArgsServer when neither is set
+        self.hostvars_include = getList(config, 'hostvars_include')
+        self.hostvars_exclude = getList(config, 'hostvars_exclude')
+        self.ip_details = 'full'
+        if config.has_option('ovh', 'ip_details'):
+            self.ip_details = config.get('ovh', 'ip_details')
+        if self.ip_details not in ('none', 'list', 'full'):
+            raise ValueError("ip_details must be one of none, list, full")
+        self.cloud = True
+        if config.has_option('ovh', 'cloud'):
+            self.cloud = config.getboolean('ovh', 'cloud')
+        self.ip_source = 'service'
+        if config.has_option('ovh', 'ip_source'):
+            self.ip_source = config.get('ovh', 'ip_source')
+        if self.ip_source not in ('service', 'account'):
+            raise ValueError("ip_source must be one of service, account")
+        if not self.needs_ips() and not self.wants('primary_ip') and self.configHostname != 'primary_ip':
+            # no IP call when nothing uses them
+            self.ip_details = 'none'
+        # fetched objects are shared with the modules, the inventory never reads them back
+        self.object_cache = None
+        if not config.has_option('ovh', 'object_cache') or config.getboolean('ovh', 'object_cache'):
+            ttls = dict(DEFAULT_OBJECT_TTLS)
+            if config.has_option('ovh', 'object_cache_ttls'):
+                ttls.update(parsePairs(config.get('ovh', 'object_cache_ttls')))
+            self.object_cache = ttls
 
 
         # Cache related
-        cache_path = config.get('ovh', 'cache_path')
-        self.cache_path_cache = cache_path + "/ansible-ovh.cache"
-        self.cache_path_inventory = cache_path + "/ansible-ovh.index"
-        self.cache_max_age = config.getint('ovh', 'cache_max_age')
+        for key, value in getCacheSettings(config).items():
+            setattr(self, key, value)
+        self.volatile_max_age = self.cache_max_age
+        if config.has_option('ovh', 'volatile_max_age'):
+            self.volatile_max_age = config.getint('ovh', 'volatile_max_age')
+        self.static_max_age = 86400
+        if config.has_option('ovh', 'static_max_age'):
+            self.static_max_age = config.getint('ovh', 'static_max_age')
+        self.history_size = getInt(config, 'history_size', 100)
 
     def parse_cli_args(self):
         """ Command line argument processing """
@@ -152,40 +754,266 @@ class OvhInventory(object):
         parser = argparse.ArgumentParser(description='Produce an Ansible Inventory file based on OVH')
         parser.add_argument('--list', action='store_true', default=True, help='List instances (default: True)')
         parser.add_argument('--host', action='store', help='Get all the variables about a specific instance')
+        parser.add_argument('--pretty', action='store_true', default=False,
+                            help='Indent the --list output (default: False - compact)')
         parser.add_argument('--refresh-cache', action='store_true', default=False,
                             help='Force refresh of cache by making API requests to ovh (default: False - use cache files)')
+        parser.add_argument('--daemon', action='store_true', default=False,
+                            help='Stay resident, keep the inventory in memory and answer --list/--host '
+                                 'of other runs on a unix socket (default: False)')
+        parser.add_argument('--changes-since', type=float, metavar='GENERATION|TIME',
+                            help='Only output the hosts added, removed or modified (state, IPs, reverse) since '
+                                 'a generation of the hosts, or a unix time')
+        parser.add_argument('--changes-format', choices=['diff', 'inventory'], default='diff',
+                            help='--changes-since output: added/modified hostvars and removed hosts, or an '
+                                 'inventory of the added and modified hosts (default: diff)')
+        parser.add_argument('--region', default=os.environ.get(FILTER_ENV["region"]),
+                            help='Only refresh and list these regions, comma separated ({})'.format(FILTER_ENV["region"]))
+        parser.add_argument('--type', default=os.environ.get(FILTER_ENV["type"]),
+                            help='Only refresh and list these types of services, among vps, server and cloud, '
+                                 'comma separated ({})'.format(FILTER_ENV["type"]))
+        parser.add_argument('--group', default=os.environ.get(FILTER_ENV["group"]),
+                            help='Only list the hosts of these groups, comma separated shell patterns '
+                                 '({})'.format(FILTER_ENV["group"]))
+        parser.add_argument('--hosts', default=os.environ.get(FILTER_ENV["hosts"]),
+                            help='Only list the hosts whose hostname or service name match these comma '
+                                 'separated shell patterns ({})'.format(FILTER_ENV["hosts"]))
+        parser.add_argument('--profile', nargs='?', const='-', metavar='FILE',
+                            help='Summarize the API calls per endpoint on stderr, or as JSON in FILE')
+        # used by the detached run refreshing a stale cache
+        parser.add_argument('--background-refresh', action='store_true', default=False, help=argparse.SUPPRESS)
         self.args = parser.parse_args()
 
-    def add_to_cache(self, d, type,region):
+        self.filters = dict((key, splitList(getattr(self.args, key))) for key in FILTER_ENV)
+        for region in self.filters["region"] or []:
+            if region not in self.regions:
+                parser.error("--region {0} is not among the regions of ovh.ini: {1}".format(region, ", ".join(self.regions)))
+        for type in self.filters["type"] or []:
+            if type not in self.service_types():
+                parser.error("--type must be among {}".format(", ".join(self.service_types())))
+
+    def scope(self):
+        """ (regions, types) to refresh given the filters, None for all of them """
+        regions = types = None
+        if self.filters["region"]:
+            regions = [region for region in self.regions if region in self.filters["region"]]
+        if self.filters["type"]:
+            types = [type for type in self.service_types() if type in self.filters["type"]]
+        return regions, types
+
+    def service_types(self):
+        """ Types of services fetched """
+        return ["vps", "server", "cloud"] if self.cloud else ["vps", "server"]
+
+    def add_to_cache(self, d, type, region, patterns=None):
+        """ Adds a service record to hosts and groups, returns its hostname.
+            With patterns, only when its hostname or service name matches one of them """
         d["region"] = region
         d["type"] = type
         cleanUpHost(d)
         host = None
         if self.configHostname == "primary_ip":
-            host = d["primary_ip"]
+            host = d.get("primary_ip", d["name"])
         if self.configHostname == "servicename":
             host = d["name"]
         if self.configHostname == "customname":
-            fallback = d["primary_ip"] if "reverse" not in d else d["reverse"]
+            fallback = d.get("primary_ip", d["name"]) if "reverse" not in d else d["reverse"]
             host = fallback if "displayname" not in d else d["displayname"]
+        if patterns and not any(fnmatchcase(host, p) or fnmatchcase(d["name"], p) for p in patterns):
+            return None
+
+        for group in self.host_groups(d):
+            self.push(self.inventory, group, host)
+        self.cache[host] = self.project(d, type)
+        self.fingerprints[host] = fingerprint(d)
+        return host
+
+    def host_groups(self, d):
+        """ Groups of a host: its values of the group_by keys, as they are, and its
+            computed groups, named after their prefix (datacenter_rbx1, subnet_10_1_0_0_16) """
+        # other values are named as JSON keys, true rather than True
+        groups = [d[gb] if isinstance(d[gb], basestring) else json.dumps(d[gb]) for gb in self.Groupby if gb in d]
+        if d["type"] == "cloud":
+            groups.append(self.to_safe(u"cloud_project_{}".format(d["project_name"])))
+            if d.get("zone"):
+                groups.append(self.to_safe(u"cloud_region_{}".format(d["zone"])))
+        for gb in self.computed_groups:
+            if gb == "subnet":
+                ips = [d["primary_ip"]] if "primary_ip" in d else []
+                for version_ips in (d.get("ips") or {}).values():
+                    ips.extend(version_ips)
+                for ip in ips:
+                    groups.extend(self.to_safe("subnet_{}".format(network)) for network in self.subnets.lookup(ip))
+            else:
+                value = COMPUTED_GROUPS[gb](d)
+                if value:
+                    groups.append(self.to_safe(u"{0}_{1}".format(gb, value)))
+        return groups
+
+    def needs_ips(self):
+        """ True if the IP lists are used, as hostvars or for subnet groups """
+        return self.wants('ips') or "subnet" in self.computed_groups
+
+    def wants(self, key):
+        """ True if hostvars_include/hostvars_exclude keep the hostvar key """
+        if self.hostvars_include is not None:
+            return key in self.hostvars_include
+        if self.hostvars_exclude is not None:
+            return key not in self.hostvars_exclude
+        return True
+
+    def project(self, d, type):
+        """ The hostvars of d kept by the settings, see read_settings """
+        if self.hostvars_include is None and self.hostvars_exclude is None:
+            removed = {"vps": removeArgsVps, "server": removeArgsServer}.get(type, [])
+            removed = set(k.lower() for k in removed)
+            return dict((k, v) for k, v in d.items() if k not in removed)
+        return dict((k, v) for k, v in d.items() if self.wants(k))
+
+    def pool_map(self, func, items, workers=None):
+        """ Applies func to every item using at most workers threads, results keep the order of items """
+        items = list(items)
+        if workers is None:
+            workers = self.workers
+        workers = min(workers, len(items))
+        if workers <= 1:
+            return [func(item) for item in items]
+        pool = ThreadPool(workers)
+        try:
+            return pool.map(func, items)
+        finally:
+            pool.close()
+            pool.join()
+
+    def get_chunk(self, conn, template, keys, *args):
+        """ getChunk, batch_size keys per call. A key that can't be fetched gets the API error as value """
+        return getChunk(conn, template, keys, args, self.batch_size, self.batch_unsupported)
+
+    def get_batch(self, conn, template, keys):
+        """ Same as get_chunk, with the batches spread over the worker pool """
+        keys = list(keys)
+        chunks = [keys[i:i + self.batch_size] for i in range(0, len(keys), self.batch_size)]
+        results = self.pool_map(lambda chunk: self.get_chunk(conn, template, chunk), chunks)
+        return [value for chunk in results for value in chunk]
+
+    def classify_ips(self, ips):
+        """ IPs (or blocks) by version, told apart locally """
+        list_ips = dict()
+        for _ip in ips:
+            ip = _ip.split('/')[0]
+            v = 'v' + str(ipaddress.ip_address(ip).version).lower()
+            if v not in list_ips:
+                list_ips[v] = []
+            list_ips[v].append(ip)
+        return list_ips
+
+    def account_ips(self, conn):
+        """ IP blocks of the account by the service they are routed to, as
+            {service: [(block, type)]}: /ip lists them, their details are fetched in
+            batches over the worker pool. Built once per client, the API error instead
+            when /ip can't be listed. A block whose details can't be fetched is skipped """
+        if conn in self.ip_indexes:
+            return self.ip_indexes[conn]
+        try:
+            blocks = conn.get('/ip')
+        except ovh.APIError as e:
+            self.ip_indexes[conn] = e
+            return e
+        # blocks have a / to escape, as in 192.0.2.0%2F24
+        details = self.get_batch(conn, '/ip/{}', [quote(block, safe='') for block in blocks])
+        index = dict()
+        for block, detail in zip(blocks, details):
+            if isFailure(detail):
+                warn("unable to fetch {0} IP block {1}, skipped: {2}".format(conn.label, block, detail))
+                continue
+            if detail.get("routedTo") and detail["routedTo"].get("serviceName"):
+                index.setdefault(detail["routedTo"]["serviceName"], []).append((block, detail.get("type")))
+        self.ip_indexes[conn] = index
+        return index
 
-        self.cache[host] = d
-        for gb in self.Groupby:
-            if gb in d:
-                self.push(self.inventory, d[gb] , host)
-
-    def get_vps(self, region):
-        data = self.conn.get('/vps')
-        for host in data:
-            vps = dict()
-            #self.cache[host] = host
-            vps = self.conn.get('/vps/{}'.format(host))
-            for k in removeArgsVps:
-                removeKey(vps, k)
-            ips = self.conn.get('/vps/{}/ips'.format(host))
+    def service_ips(self, conn, name, with_types=True):
+        """ IP blocks routed to a single service, indexed as by account_ips: a few calls
+            instead of the details of every block of the account. Their types are only
+            fetched with_types, a block whose details can't be fetched has None """
+        try:
+            blocks = conn.get('/ip', **{"routedTo.serviceName": name})
+        except ovh.APIError as e:
+            return e
+        types = [None] * len(blocks)
+        if with_types:
+            details = self.get_batch(conn, '/ip/{}', [quote(block, safe='') for block in blocks])
+            types = [None if isFailure(detail) else detail.get("type") for detail in details]
+        return {name: list(zip(blocks, types))}
+
+    def get_account_ips(self, conn, names, result):
+        """ Sets the IPs of the fetched records in result from account_ips, the primary
+            IP of a vps being the first IPv4 of its vps typed blocks. A single service
+            (--host) only gets its own blocks, see service_ips """
+        fetched = [i for i, record in enumerate(result) if not isFailure(record)]
+        if not fetched:
+            # no record to set the IPs of
+            return result
+        if len(fetched) == 1 and conn not in self.ip_indexes:
+            i = fetched[0]
+            index = self.service_ips(conn, names[i], "ip" not in result[i])
+        else:
+            index = self.account_ips(conn)
+        for i, name in enumerate(names):
+            if isFailure(result[i]):
+                continue
+            if isFailure(index):
+                result[i] = index
+                continue
+            blocks = index.get(name, [])
+            result[i]["ips"] = self.classify_ips([block for block, type in blocks])
+            if "ip" not in result[i]:
+                primary = self.classify_ips([block for block, type in blocks if type == "vps"])
+                if primary.get("v4"):
+                    result[i]["ip"] = primary["v4"][0]
+        return result
+
+    def get_vps(self, conn, names, with_ips=True):
+        """ Fetches the records of the given vps, a vps that can't be fetched gets the API error instead.
+            IPs are fetched as set by ip_details: not at all, as a list (the primary IP being
+            the first IPv4), or with their details (one more call per IP, for their type) """
+        result = self.get_batch(conn, '/vps/{}', names)
+        if not with_ips or self.ip_details == 'none':
+            return result
+        if self.ip_source == 'account':
+            return self.get_account_ips(conn, names, result)
+
+        fetched = [i for i, vps in enumerate(result) if not isFailure(vps)]
+        hosts = [names[i] for i in fetched]
+        ip_lists = self.get_batch(conn, '/vps/{}/ips', hosts)
+
+        if self.ip_details == 'list':
+            for i, ips in zip(fetched, ip_lists):
+                if isFailure(ips):
+                    result[i] = ips
+                    continue
+                vps = result[i]
+                vps["ips"] = self.classify_ips(ips)
+                if vps["ips"].get("v4"):
+                    vps["ip"] = vps["ips"]["v4"][0]
+            return result
+
+        def fetch_ips(host_ips):
+            host, ips = host_ips
+            if isFailure(ips):
+                return [ips]
+            return self.get_chunk(conn, '/vps/{}/ips/{}', ips, host)
+
+        # one batch per host for the IP details, bounded by the pool
+        ip_infos = self.pool_map(fetch_ips, zip(hosts, ip_lists))
+
+        for i, ips, infos in zip(fetched, ip_lists, ip_infos):
+            failures = [info for info in infos if isFailure(info)]
+            if failures:
+                result[i] = failures[0]
+                continue
+            vps = result[i]
             list_ips=dict()
-            for ip in ips:
-                ip_info = self.conn.get('/vps/{0}/ips/{1}'.format(host,ip))
+            for ip, ip_info in zip(ips, infos):
                 v = ip_info["version"]
                 if ip_info["type"] == "primary" and v == "v4":
                     vps["ip"] = ip
@@ -194,64 +1022,425 @@ class OvhInventory(object):
                 list_ips[v].append(ip)
 
             vps["ips"]=list_ips
-            self.add_to_cache(vps, "vps", region)
-
-
-    def get_dedicated(self, region):
-        data = self.conn.get('/dedicated/server')
-        for host in data:
-            c = dict()
-            server = dict()
-            #self.cache[host] = host
-            server = self.conn.get('/dedicated/server/{}'.format(host))
-            c["reverse"] = server["reverse"] if server["reverse"] else server['ip']
-            for k in removeArgsServer:
-                removeKey(server, k)
-            ips = self.conn.get('/dedicated/server/{}/ips'.format(host))
-            list_ips = dict()
-            for _ip in ips:
-                ip = _ip.split('/')[0]
-                ip_info = dict()
-                v = 'v' + str(ipaddress.ip_address(ip).version).lower()
-                if v not in list_ips:
-                    list_ips[v] = []
-                list_ips[v].append(ip)
+        return result
+
+    def get_dedicated(self, conn, names, with_ips=True):
+        """ Fetches the records of the given servers, a server that can't be fetched gets the API error instead.
+            Their record has the primary IP, the IP list is fetched when ips is kept, unless ip_details is none """
+        result = self.get_batch(conn, '/dedicated/server/{}', names)
+        if not with_ips or self.ip_details == 'none' or not self.needs_ips():
+            return result
+        if self.ip_source == 'account':
+            return self.get_account_ips(conn, names, result)
+
+        fetched = [i for i, server in enumerate(result) if not isFailure(server)]
+        ip_lists = self.get_batch(conn, '/dedicated/server/{}/ips', [names[i] for i in fetched])
+        for i, ips in zip(fetched, ip_lists):
+            if isFailure(ips):
+                result[i] = ips
+                continue
+            result[i]["ips"] = self.classify_ips(ips)
+        return result
+
+    def refresh_services(self, conn, region, type, old, force=False):
+        """ Incremental refresh of the services of a type:
+            new services are fetched, removed ones dropped, the others refreshed
+            when their volatile (details) or static (IP) fields are older than allowed.
+            A service that can't be fetched keeps its previous record. None if the
+            services can't be listed """
+        list_path, fetch = {
+            "vps": ('/vps', self.get_vps),
+            "server": ('/dedicated/server', self.get_dedicated),
+        }[type]
+        old = old or {"names": [], "services": {}}
+        try:
+            names = conn.get(list_path)
+        except ovh.APIError as e:
+            warn("unable to list {0} {1}, keeping cached services: {2}".format(region, list_path, e))
+            return None
 
-            server["ips"]=list_ips
-            self.add_to_cache(server, "server", region)
+        now = time()
+        services = dict()
+        static = []
+        volatile = []
+        for name in names:
+            entry = old["services"].get(name)
+            if force or entry is None or entry["static"] + self.static_max_age <= now:
+                static.append(name)
+            elif entry["volatile"] + self.volatile_max_age <= now:
+                volatile.append(name)
+            else:
+                services[name] = entry
 
-    def update_cache(self):
-        """ Make calls to ovh and save the output in a cache """
+        for name, record in zip(static, fetch(conn, static)):
+            if not isFailure(record):
+                services[name] = {"record": record, "static": now, "volatile": now}
+            elif name in old["services"]:
+                warn("unable to refresh {0} {1}, keeping cached record: {2}".format(type, name, record))
+                services[name] = old["services"][name]
+            else:
+                warn("unable to fetch {0} {1}, skipped: {2}".format(type, name, record))
+
+        for name, record in zip(volatile, fetch(conn, volatile, False)):
+            entry = dict(old["services"][name])
+            if not isFailure(record):
+                # keep the IP fields, refreshed on the static tier only
+                for k in ("ip", "ips"):
+                    if k in entry["record"] and k not in record:
+                        record[k] = entry["record"][k]
+                entry["record"] = record
+                entry["volatile"] = now
+            else:
+                warn("unable to refresh {0} {1}, keeping cached record: {2}".format(type, name, record))
+            services[name] = entry
+
+        return {"names": [name for name in names if name in services], "services": services}
+
+    def list_instances(self, conn, project):
+        """ Instances of a cloud project, full records in a single call, the API error if it fails """
+        try:
+            return conn.get('/cloud/project/{}/instance', project)
+        except ovh.APIError as e:
+            return e
+
+    def cloud_record(self, instance, project, description):
+        """ Service record of a cloud instance: its region becomes zone (region being the API
+            region of every service), its name the display name, its public IPv4 the primary IP """
+        record = dict(instance)
+        # the name is chosen by the user, as the display name of other services
+        record["displayName"] = instance["name"]
+        record["zone"] = record.pop("region", None)
+        record["project"] = project
+        record["project_name"] = description or project
+        addresses = record.pop("ipAddresses", None) or []
+        record["ips"] = self.classify_ips([address["ip"] for address in addresses])
+        for address in addresses:
+            if address.get("type") == "public" and str(address.get("version")) == "4":
+                record["ip"] = address["ip"]
+                break
+        return record
+
+    def get_cloud(self, conn):
+        """ Instances of every cloud project: (project, description, instances) triples, the
+            instances being the API error of a project that can't be listed. One call per
+            project whatever the number of instances, the project descriptions in batches """
+        projects = conn.get('/cloud/project')
+        details = self.get_batch(conn, '/cloud/project/{}', projects)
+        listings = self.pool_map(lambda project: self.list_instances(conn, project), projects)
+        return [(project, None if isFailure(detail) else detail.get("description"), instances)
+                for project, detail, instances in zip(projects, details, listings)]
+
+    def refresh_cloud(self, conn, region, old, force=False):
+        """ Refreshes the cloud instances, keyed by id: the listings have full records, so
+            every refresh lists them all. A project that can't be listed keeps its instances.
+            None if the projects can't be listed, no instances when the credentials aren't
+            granted /cloud (consumer keys restricted to /vps and /dedicated) """
+        old = old or {"names": [], "services": {}}
+        try:
+            projects = self.get_cloud(conn)
+        except (ovh.NotGrantedCall, ovh.Forbidden) as e:
+            warn("{0} /cloud/project not granted, no cloud instances listed: {1}".format(region, e))
+            return {"names": [], "services": {}}
+        except ovh.APIError as e:
+            warn("unable to list {0} /cloud/project, keeping cached instances: {1}".format(region, e))
+            return None
+
+        now = time()
+        names = []
+        services = dict()
+        for project, description, instances in projects:
+            if isFailure(instances):
+                warn("unable to list instances of {0} cloud project {1}, keeping cached ones: {2}".format(
+                    region, project, instances))
+                kept = [name for name in old["names"] if old["services"][name]["record"].get("project") == project]
+                names.extend(kept)
+                services.update((name, old["services"][name]) for name in kept)
+                continue
+            for instance in instances:
+                names.append(instance["id"])
+                services[instance["id"]] = {"record": self.cloud_record(instance, project, description),
+                                            "static": now, "volatile": now}
+        return {"names": names, "services": services}
+
+    def find_cloud_instance(self, conn, name):
+        """ (id, record) of the cloud instance called name, (None, None) if there is none """
+        try:
+            projects = self.get_cloud(conn)
+        except ovh.APIError:
+            return None, None
+        for project, description, instances in projects:
+            for instance in ([] if isFailure(instances) else instances):
+                if instance.get("name") == name:
+                    return instance["id"], self.cloud_record(instance, project, description)
+        return None, None
+
+    def connect(self, region):
+        """ API client of a region, its keep-alive session is shared by all the workers """
+        client = buildClient(endpoint=region, time_delta_cache=self.cache_path_time, pool_size=self.workers)
+        cache = None
+        if self.object_cache is not None:
+            cache = ObjectCache(self.cache_path_objects, self.object_cache)
+        return OvhApi(client, rate_limits=self.rate_limits, retries=self.retries, stats=self.stats, label=region,
+                      cache=cache, cache_reads=False)
+
+    def refresh_region(self, region, force=False, types=None):
+        """ Refreshes vps, dedicated servers and cloud instances of a region, or only types,
+            with its own client. The other types keep their cached services.
+            Returns the services and the types that couldn't be listed """
+        old = self.state["regions"].get(region, {})
+        services = dict((type, old[type]) for type in self.service_types() if type in old)
+        try:
+            conn = self.connect(region)
+        except ovh.APIError as e:
+            warn("unable to connect to {0}, keeping cached services: {1}".format(region, e))
+            return services, list(types or self.service_types())
+        failed = []
+        for type in (types or self.service_types()):
+            if type == "cloud":
+                refreshed = self.refresh_cloud(conn, region, old.get(type), force)
+            else:
+                refreshed = self.refresh_services(conn, region, type, old.get(type), force)
+            if refreshed is None:
+                # not listed: the cached services keep their refresh time, see is_scope_valid
+                failed.append(type)
+                continue
+            services[type] = dict(refreshed, refreshed=time())
+        return services, failed
+
+    def update_cache(self, force=False, regions=None, types=None):
+        """ Make calls to ovh and save the output in a cache. Only regions and types
+            when given, the other services are kept as cached and don't get fresher.
+            Services that can't be listed are kept as cached too, raises RefreshError
+            when some of them never were. Nothing is written when none could be listed """
         self.groups = dict()
         self.hosts = dict()
-        for region in self.regions:
-            self.conn = ovh.Client(endpoint=region)
-            self.get_vps(region)
-            self.get_dedicated(region)
+        self.ip_indexes = dict()
+        self.load_state_from_cache()
+        scope = regions or self.regions
+        results = self.pool_map(lambda region: self.refresh_region(region, force, types), scope, len(scope))
+        refreshed = dict((region, services) for region, (services, failed) in zip(scope, results))
+        failed = [(region, type) for region, (services, types_failed) in zip(scope, results) for type in types_failed]
+        missing = ["{0} {1}".format(region, type) for region, type in failed if type not in refreshed[region]]
+        if missing:
+            raise RefreshError("unable to list {}, with no cached services to use instead".format(", ".join(missing)))
+        self.state["regions"] = dict((region, refreshed.get(region, self.state["regions"].get(region, {})))
+                                     for region in self.regions)
+        self.rebuild_cache()
 
-        self.write_to_cache(self.cache, self.cache_path_cache)
-        self.write_to_cache(self.inventory, self.cache_path_inventory)
+        if len(failed) == len(scope) * len(types or self.service_types()):
+            # the cache stays as old as it was
+            return
+        if failed or len(scope) < len(self.regions) or len(types or self.service_types()) < len(self.service_types()):
+            self.write_merged_to_cache()
+        else:
+            self.write_all_to_cache()
+
+    def rebuild_cache(self, regions=None, types=None, patterns=None):
+        """ Builds hosts and groups from the refresh state, in region/listing order so
+            output does not depend on timing. Only the hosts of regions and types, and
+            matching patterns (see add_to_cache), when given """
+        self.cache = dict()
+        self.inventory = dict()
+        self.group_members = dict()
+        self.fingerprints = dict()
+        for region in (regions or self.regions):
+            for type in (types or ("vps", "server", "cloud")):
+                services = self.state["regions"].get(region, {}).get(type, {"names": []})
+                for name in services["names"]:
+                    self.add_to_cache(copy.deepcopy(services["services"][name]["record"]), type, region, patterns)
+
+    def filter_groups(self, patterns):
+        """ Keeps the hosts of the groups matching patterns, and the groups of those hosts """
+        kept = set(host for group, hosts in self.inventory.items()
+                   if any(fnmatchcase(group, pattern) for pattern in patterns) for host in hosts)
+        self.cache = dict((host, hostvars) for host, hostvars in self.cache.items() if host in kept)
+        groups = ((group, [host for host in hosts if host in kept]) for group, hosts in self.inventory.items())
+        self.inventory = dict((group, hosts) for group, hosts in groups if hosts)
+
+    def run_daemon(self):
+        """ Keeps hosts and groups in memory and answers the requests of other runs
+            on the daemon socket, refreshing the cache when it expires """
+        import SocketServer
+        import signal
+        import socket
+        import threading
+
+        inventory = self
+        self.daemon_lock = threading.Lock()
+        self.load_or_refresh()
+
+        class Handler(SocketServer.StreamRequestHandler):
+            def handle(self):
+                line = self.rfile.readline()
+                if not line:
+                    # closed without a request, as by the check of a starting daemon
+                    return
+                request = line.strip().split(' ', 1)
+                for chunk in inventory.answer(request):
+                    self.wfile.write(chunk)
+
+        if os.path.lexists(self.cache_path_socket):
+            probe = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+            try:
+                probe.connect(self.cache_path_socket)
+                listening = True
+            except socket.error:
+                listening = False
+            finally:
+                probe.close()
+            if listening:
+                warn("a daemon already answers on {}, not started".format(self.cache_path_socket))
+                sys.exit(1)
+            if os.lstat(self.cache_path_socket).st_uid != os.getuid():
+                warn("{} belongs to another user, not started".format(self.cache_path_socket))
+                sys.exit(1)
+            # left by a daemon that didn't exit cleanly
+            os.unlink(self.cache_path_socket)
+        server = SocketServer.ThreadingUnixStreamServer(self.cache_path_socket, Handler)
+        server.daemon_threads = True
+        os.chmod(self.cache_path_socket, 0o600)
+        inode = os.stat(self.cache_path_socket).st_ino
+
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        refresher = threading.Thread(target=self.refresh_loop)
+        refresher.daemon = True
+        refresher.start()
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            server.server_close()
+            try:
+                # unless already removed, or replaced by another daemon
+                if os.stat(self.cache_path_socket).st_ino == inode:
+                    os.unlink(self.cache_path_socket)
+            except OSError:
+                pass
+
+    def load_or_refresh(self):
+        """ Refreshes the cache if it expired, or loads it, then publishes it to the daemon requests """
+        # the calls of each refresh only, they would pile up over the life of the daemon
+        self.stats = CallStats()
+        if not self.refresh():
+            self.load_inventory_from_cache()
+            self.load_cache_from_cache()
+        self.publish()
+
+    def publish(self):
+        # requests only see complete data, a refresh builds new dicts
+        self.served = (''.join(self.list_chunks()), self.inventory, self.cache, os.path.getmtime(self.cache_path_cache))
+
+    def refresh_loop(self):
+        """ Refreshes the daemon data once the cache expired, or reloads it when another run wrote it """
+        while True:
+            sleep(DAEMON_POLL_INTERVAL)
+            try:
+                if not self.is_cache_valid() or os.path.getmtime(self.cache_path_cache) != self.served[3]:
+                    with self.daemon_lock:
+                        self.load_or_refresh()
+            except Exception as e:
+                warn("daemon refresh failed, still serving the previous inventory: {}".format(e))
+
+    def answer(self, request):
+        """ Answer of the daemon to a 'list', 'list pretty' or 'host <name>' request, as chunks """
+        list_info, inventory, cache, mod_time = self.served
+        if request == ['list']:
+            return [list_info]
+        if request == ['list', 'pretty']:
+            return listChunks(inventory, ((host, cache[host]) for host in sorted(cache)), True)
+        if request[0] == 'host' and len(request) == 2:
+            hostvars = cache.get(request[1])
+            if hostvars is None:
+                with self.daemon_lock:
+                    hostvars = self.fetch_host(request[1])
+                    self.publish()
+            return [self.json_format_dict(hostvars or {}, True) + "\n"]
+        return [self.json_format_dict({}, True) + "\n"]
+
+    def write_profile(self, filename):
+        """ Writes the API calls summary to stderr ('-') or as JSON to filename """
+        if filename == '-':
+            sys.stderr.write(self.stats.report())
+        else:
+            with open(filename, 'w') as f:
+                f.write(self.json_format_dict(self.stats.summary(), True))
+
+    def list_chunks(self, pretty=False, from_cache=False):
+        """ Groups and variables of all hosts, as printed by --list, see listChunks.
+            Hosts are read one at a time from the cache file when from_cache """
+        if from_cache:
+            hosts = self.backend.read_records(self.cache_path_cache)
+        else:
+            hosts = ((host, self.cache[host]) for host in sorted(self.cache))
+        return listChunks(self.inventory, hosts, pretty)
 
     def get_host_info(self):
         """ Get variables about a specific host """
 
-        if not self.cache or len(self.cache) == 0:
-            # Need to load index from cache
-            self.load_cache_from_cache()
+        if self.cache:
+            hostvars = self.cache.get(self.args.host)
+        else:
+            # Only read this host from the host index
+            hostvars = self.load_host_from_cache(self.args.host)
 
-        if not self.args.host in self.cache:
-            # try updating the cache
-            self.update_cache()
+        if hostvars is None:
+            # try fetching this host only
+            hostvars = self.fetch_host(self.args.host)
 
-            if not self.args.host in self.cache:
+            if hostvars is None:
                 # host might not exist anymore
                 return self.json_format_dict({}, True)
 
-        return self.json_format_dict(self.cache[self.args.host], True)
+        return self.json_format_dict(hostvars, True)
+
+    def fetch_host(self, name):
+        """ Looks a single service up in every region, as a vps, a dedicated server, then
+            a cloud instance, and merges it into the cache. Returns its variables, None if it can't be found """
+
+        for region in self.regions:
+            try:
+                conn = self.connect(region)
+            except ovh.APIError as e:
+                warn("unable to connect to {0}: {1}".format(region, e))
+                continue
+            key = name
+            for type, fetch in (("vps", self.get_vps), ("server", self.get_dedicated)):
+                record = fetch(conn, [name])[0]
+                if not isFailure(record):
+                    break
+            else:
+                if not self.cloud:
+                    continue
+                # instances are keyed by id
+                type = "cloud"
+                key, record = self.find_cloud_instance(conn, name)
+                if record is None:
+                    continue
+
+            with self.refresh_lock():
+                self.load_state_from_cache()
+                services = self.state["regions"].setdefault(region, {}).setdefault(type, {"names": [], "services": {}})
+                if key not in services["services"]:
+                    services["names"].append(key)
+                now = time()
+                services["services"][key] = {"record": record, "static": now, "volatile": now}
+                self.rebuild_cache()
+                self.write_merged_to_cache()
+
+            for hostvars in self.cache.values():
+                if (hostvars["name"], hostvars["type"], hostvars["region"]) == (name, type, region):
+                    return hostvars
+        return None
 
     def push(self, my_dict, key, element):
-        """ Pushed an element onto an array that may not have been defined in the dict """
+        """ Pushed an element onto an array that may not have been defined in the dict,
+            once: group_members has the elements of each array as a set """
 
+        members = self.group_members.setdefault(key, set())
+        if element in members:
+            return
+        members.add(element)
         if key in my_dict:
             my_dict[key].append(element)
         else:
@@ -270,23 +1459,150 @@ class OvhInventory(object):
     def load_inventory_from_cache(self):
         """ Reads the index from the cache file sets self.index """
 
-        cache = open(self.cache_path_inventory, 'r')
-        json_inventory = cache.read()
-        self.inventory = json.loads(json_inventory)
+        self.inventory = self.backend.read(self.cache_path_inventory)
+
+    def load_state_from_cache(self):
+        """ Reads the refresh state from the cache file sets self.state, empty if there is none """
+
+        self.state = {"regions": {}}
+        if not os.path.isfile(self.cache_path_state):
+            return
+        try:
+            self.state = self.backend.read(self.cache_path_state)
+        except (ValueError, zlib.error) as e:
+            warn("ignoring unreadable state file {0}: {1}".format(self.cache_path_state, e))
 
     def load_cache_from_cache(self):
         """ Reads the cache from the cache file sets self.cache """
 
-        cache = open(self.cache_path_cache, 'r')
-        json_cache = cache.read()
-        self.cache = json.loads(json_cache)
+        self.cache = dict(self.backend.read_records(self.cache_path_cache))
+
+    def load_host_from_cache(self, host):
+        """ Reads a single host from the cache file, using its record index. None if unknown """
+
+        if not self.backend.is_readable(self.cache_path_cache):
+            return None
+        return self.backend.read_record(self.cache_path_cache, host)
+
+    def write_hosts_to_cache(self, hosts):
+        """ Writes hosts to the cache file, one record per host """
+        self.backend.write_records(self.cache_path_cache, ((host, hosts[host]) for host in sorted(hosts)))
+
+    def write_all_to_cache(self):
+        """ Writes refresh state, hosts, groups, the --list output used by the fast path and the history """
+        self.write_to_cache(self.state, self.cache_path_state)
+        self.write_hosts_to_cache(self.cache)
+        self.write_to_cache(self.inventory, self.cache_path_inventory)
+        atomicWrite(self.cache_path_list, self.list_chunks())
+        self.write_history()
+
+    def write_merged_to_cache(self):
+        """ write_all_to_cache, keeping the cache time: merging a host, or refreshing
+            some regions or types, doesn't make the other ones fresher. Without a
+            previous cache, the new one is expired """
+        mod_time = 0
+        if os.path.isfile(self.cache_path_cache):
+            mod_time = os.path.getmtime(self.cache_path_cache)
+        self.write_all_to_cache()
+        os.utime(self.cache_path_cache, (mod_time, mod_time))
+
+    def load_history(self):
+        """ Snapshots of the hosts, see write_history, None if there are none """
+        if not self.backend.is_readable(self.cache_path_history):
+            return None
+        try:
+            history = self.backend.read(self.cache_path_history)
+        except (ValueError, zlib.error) as e:
+            warn("ignoring unreadable history file {0}: {1}".format(self.cache_path_history, e))
+            return None
+        if not isinstance(history, dict) or "base" not in history:
+            warn("ignoring history file {} of an older format".format(self.cache_path_history))
+            return None
+        return history
+
+    def write_history(self):
+        """ Adds a snapshot of the hosts to the history when they changed since the last one,
+            as the next generation and its time. The history holds the fingerprint of every
+            host in its oldest snapshot (base), and the hosts changed and removed by each
+            later generation (deltas). Keeps the last history_size snapshots, older deltas
+            are merged into the base """
+        if self.history_size <= 0:
+            return
+        history = self.load_history()
+        if history is None:
+            history = {"base": {"generation": 1, "time": time(), "hosts": self.fingerprints}, "deltas": []}
+        else:
+            latest = dict(history["base"]["hosts"])
+            for delta in history["deltas"]:
+                applyDelta(latest, delta)
+            if latest == self.fingerprints:
+                return
+            last = (history["deltas"] or [history["base"]])[-1]
+            history["deltas"].append(dict(historyDelta(latest, self.fingerprints),
+                                          generation=last["generation"] + 1, time=time()))
+            base = history["base"]
+            while len(history["deltas"]) >= self.history_size:
+                delta = history["deltas"].pop(0)
+                applyDelta(base["hosts"], delta)
+                base["generation"], base["time"] = delta["generation"], delta["time"]
+        self.write_to_cache(history, self.cache_path_history)
+
+    def get_changes(self, since, inventory=False):
+        """ Hosts added, modified and removed since the generation since, or since the
+            unix time since (the snapshot current then). With inventory, the groups
+            and hostvars of the added and modified hosts, in changes_added and
+            changes_modified groups. A since older than the history reports every
+            host as added, complete being False """
+        history = self.load_history() or {"base": {"generation": 0, "time": 0, "hosts": {}}, "deltas": []}
+        base, deltas = history["base"], history["deltas"]
+        if base["generation"] == 1:
+            # no host before the first snapshot
+            deltas = [{"generation": 1, "time": base["time"], "changed": base["hosts"], "removed": []}] + deltas
+            base = {"generation": 0, "time": 0, "hosts": {}}
+        snapshots = [base] + deltas
+        current = snapshots[-1]
+        field = "time" if since >= CHANGES_SINCE_TIME else "generation"
+        previous = [snapshot for snapshot in snapshots if snapshot[field] <= since]
+        # the hosts of the last previous snapshot, then of the current one
+        position = max(len(previous) - 1, 0)
+        old = dict(base["hosts"])
+        for delta in deltas[:position]:
+            applyDelta(old, delta)
+        hosts = dict(old)
+        for delta in deltas[position:]:
+            applyDelta(hosts, delta)
+        if not previous:
+            old = {}
+        added = sorted(host for host in hosts if host not in old)
+        modified = sorted(host for host in hosts if host in old and old[host] != hosts[host])
+        removed = sorted(host for host in old if host not in hosts)
+
+        def hostvars(host):
+            if self.cache:
+                return self.cache.get(host, {})
+            return self.load_host_from_cache(host) or {}
+
+        if inventory:
+            changed = set(added + modified)
+            groups = dict((group, [host for host in members if host in changed])
+                          for group, members in self.inventory.items())
+            groups = dict((group, members) for group, members in groups.items() if members)
+            groups["changes_added"] = added
+            groups["changes_modified"] = modified
+            groups["_meta"] = {"hostvars": dict((host, hostvars(host)) for host in sorted(changed))}
+            return groups
+        return {
+            "generation": current["generation"],
+            "since": previous[-1]["generation"] if previous else None,
+            "complete": bool(previous),
+            "added": dict((host, hostvars(host)) for host in added),
+            "modified": dict((host, hostvars(host)) for host in modified),
+            "removed": removed,
+        }
 
     def write_to_cache(self, data, filename):
-        """ Writes data in JSON format to a file """
-        json_data = self.json_format_dict(data, True)
-        cache = open(filename, 'w')
-        cache.write(json_data)
-        cache.close()
+        """ Writes data to a file with the cache backend """
+        self.backend.write(filename, data)
 
     def to_safe(self, word):
         """ Converts 'bad' characters in a string to underscores so they can be used as Ansible groups """
@@ -301,4 +1617,9 @@ class OvhInventory(object):
         else:
             return json.dumps(data)
 
-OvhInventory()
+if __name__ == '__main__':
+    try:
+        OvhInventory().run()
+    except RefreshError as e:
+        warn(e)
+        sys.exit(1)
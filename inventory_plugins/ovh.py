@@ -0,0 +1,288 @@
+# -*- coding: utf-8 -*-
+#
+# (c) 2015, Clement Laforet <clement.laforet@gmail.com> (for ovh support)
+#
+# Ansible is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# Ansible is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with Ansible.  If not, see <http://www.gnu.org/licenses/>.
+
+from __future__ import absolute_import
+
+DOCUMENTATION = '''
+---
+name: ovh
+plugin_type: inventory
+author: Clement Laforet
+short_description: OVH vps, dedicated servers and Public Cloud instances
+description:
+    - In process equivalent of inventory/ovh.py, configured by a YAML file
+      whose name ends with ovh.yml or ovh.yaml instead of ovh.ini.
+    - Hosts, groups and hostvars are the ones of the script, with the same
+      options. The refresh state is kept in cache_path as by the script, so
+      refreshes stay incremental.
+    - With cache, the inventory is kept by the Ansible cache plugin and read
+      back without loading the ovh client while younger than cache_timeout.
+      meta refresh_inventory refetches everything, as ovh.py --refresh-cache.
+requirements: [ "ovh", "ipaddress" ]
+extends_documentation_fragment:
+    - inventory_cache
+options:
+    plugin:
+        required: true
+        choices: ['ovh']
+        description:
+            - token that ensures this is a source file for the ovh plugin
+    regions:
+        type: list
+        default: ['ovh-eu']
+        description:
+            - API endpoints to list services from
+    hostname:
+        default: customname
+        choices: ['primary_ip', 'customname', 'servicename']
+        description:
+            - inventory hostname, see ovh.ini
+    group_by:
+        type: list
+        default: ['region', 'type']
+        description:
+            - hostvars whose value is a group of the host
+    cloud:
+        type: bool
+        default: true
+        description:
+            - list the Public Cloud instances of every project
+    computed_groups:
+        type: list
+        description:
+            - among datacenter, os, offer, state and subnet, see ovh.ini
+    subnets:
+        type: list
+        description:
+            - networks of the subnet computed groups
+    hostvars_include:
+        type: list
+        description:
+            - hostvars to keep, the others are dropped
+    hostvars_exclude:
+        type: list
+        description:
+            - hostvars to drop
+    ip_details:
+        default: full
+        choices: ['none', 'list', 'full']
+        description:
+            - IP details of the vps, see ovh.ini
+    ip_source:
+        default: service
+        choices: ['service', 'account']
+        description:
+            - IP lists of each service, or /ip of the account
+    workers:
+        type: int
+        default: 8
+        description:
+            - maximum number of concurrent API calls per region
+    batch_size:
+        type: int
+        default: 50
+        description:
+            - number of services fetched per call, 1 disables batching
+    retries:
+        type: int
+        default: 3
+        description:
+            - retries of throttled and failed API calls
+    rate_limits:
+        type: dict
+        description:
+            - calls per second, per endpoint prefix
+    cache_path:
+        default: /tmp
+        description:
+            - directory of the refresh state and the object cache shared with the modules
+    cache_max_age:
+        type: int
+        default: 600
+        description:
+            - seconds before the services are refreshed
+    volatile_max_age:
+        type: int
+        description:
+            - seconds before the service details are refreshed, cache_max_age by default
+    static_max_age:
+        type: int
+        default: 86400
+        description:
+            - seconds before the IP lists and details are refreshed
+    cache_format:
+        default: json
+        choices: ['json', 'zlib']
+        description:
+            - encoding of the files in cache_path
+    refresh_lock_timeout:
+        type: int
+        default: 300
+        description:
+            - seconds waited for the refresh of another run
+    cache_stale_grace:
+        type: int
+        default: 0
+        description:
+            - seconds a cache expired for is still used, while a detached run refreshes it
+    history_size:
+        type: int
+        default: 100
+        description:
+            - snapshots of the hosts kept for ovh.py --changes-since, 0 disables them
+    object_cache:
+        type: bool
+        default: true
+        description:
+            - save the fetched service records for the modules
+    object_cache_ttls:
+        type: dict
+        description:
+            - seconds the modules use a saved object, per endpoint template
+'''
+
+EXAMPLES = '''
+# prod.ovh.yml, with inventory_plugins pointing to this repository
+plugin: ovh
+regions: [ovh-eu, ovh-ca]
+hostname: servicename
+group_by: [region, type]
+computed_groups: [datacenter, offer]
+cache: true
+cache_plugin: jsonfile
+cache_connection: /tmp/ansible-inventory
+cache_timeout: 600
+'''
+
+import imp
+import os
+import sys
+
+from ansible.errors import AnsibleError, AnsibleParserError
+from ansible.plugins.inventory import BaseInventoryPlugin, Cacheable
+
+import ConfigParser
+
+try:
+    import ovh
+    import ipaddress
+    HAS_OVH = True
+except ImportError:
+    HAS_OVH = False
+
+# options given to inventory/ovh.py as its ovh.ini settings
+OVH_OPTIONS = [
+    "regions",
+    "hostname",
+    "group_by",
+    "cloud",
+    "computed_groups",
+    "subnets",
+    "hostvars_include",
+    "hostvars_exclude",
+    "ip_details",
+    "ip_source",
+    "workers",
+    "batch_size",
+    "retries",
+    "rate_limits",
+    "cache_path",
+    "cache_max_age",
+    "volatile_max_age",
+    "static_max_age",
+    "cache_format",
+    "refresh_lock_timeout",
+    "cache_stale_grace",
+    "history_size",
+    "object_cache",
+    "object_cache_ttls",
+]
+OVH_SCRIPT = os.path.join(os.path.dirname(os.path.realpath(__file__)), '..', 'inventory', 'ovh.py')
+
+
+def loadScript():
+    """ inventory/ovh.py as a module, loaded once """
+    if 'ovh_inventory' not in sys.modules:
+        imp.load_source('ovh_inventory', OVH_SCRIPT)
+    return sys.modules['ovh_inventory']
+
+
+class InventoryModule(BaseInventoryPlugin, Cacheable):
+
+    NAME = 'ovh'
+
+    def verify_file(self, path):
+        """ YAML files named like prod.ovh.yml """
+        return super(InventoryModule, self).verify_file(path) and path.endswith(('ovh.yml', 'ovh.yaml'))
+
+    def ovh_config(self):
+        """ The plugin options, as the ovh section of ovh.ini """
+        config = ConfigParser.RawConfigParser()
+        config.add_section('ovh')
+        for option in OVH_OPTIONS:
+            value = self.get_option(option)
+            if value is None:
+                continue
+            if isinstance(value, bool):
+                value = 'yes' if value else 'no'
+            elif isinstance(value, list):
+                value = ', '.join(value)
+            elif isinstance(value, dict):
+                value = ', '.join('{0}:{1}'.format(k, v) for k, v in sorted(value.items()))
+            config.set('ovh', option, str(value))
+        return config
+
+    def get_inventory(self, force=False):
+        """ Groups and hostvars from inventory/ovh.py """
+        if not HAS_OVH:
+            raise AnsibleError('ovh and ipaddress are required for the ovh inventory plugin')
+        script = loadScript()
+        try:
+            groups, hostvars = script.OvhInventory(self.ovh_config()).load(force)
+        except (ValueError, script.RefreshError) as e:
+            raise AnsibleParserError('ovh inventory: {}'.format(e))
+        return {"groups": groups, "hostvars": hostvars}
+
+    def populate(self, results):
+        for group in sorted(results["groups"]):
+            self.inventory.add_group(group)
+            for host in results["groups"][group]:
+                self.inventory.add_host(host, group=group)
+        for host in sorted(results["hostvars"]):
+            self.inventory.add_host(host)
+            for key, value in results["hostvars"][host].items():
+                self.inventory.set_variable(host, key, value)
+
+    def parse(self, inventory, loader, path, cache=True):
+        super(InventoryModule, self).parse(inventory, loader, path, cache)
+        self._read_config_data(path)
+
+        cache_key = self.get_cache_key(path)
+        # cache is False on refresh_inventory
+        use_cache = self.get_option('cache') and cache
+        update_cache = self.get_option('cache') and not cache
+        results = None
+        if use_cache:
+            try:
+                results = self._cache[cache_key]
+            except KeyError:
+                update_cache = True
+        if results is None:
+            results = self.get_inventory(force=not cache)
+        if update_cache:
+            self._cache[cache_key] = results
+        self.populate(results)
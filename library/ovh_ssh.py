@@ -17,9 +17,24 @@ options:
         description:
             - Path to ssh public key
     name:
-        required: true
+        required: false
+        description:
+            - Name of the ssh public key, required unless keys is given.
+              Not used with keys
+    keys:
+        required: false
         description:
-            - Name of the ssh public key
+            - Full set of keys to sync, instead of name and path. Items are
+              paths of public keys, inline public keys, or dicts of name,
+              path or key, and default. Without a name, paths are named after
+              their file (without .pub), inline keys after their comment.
+              /me/sshKey is listed once, keys already up to date are left
+              alone and the other changes run concurrently
+    exclusive:
+        required: false
+        default: false
+        description:
+            - with keys, delete the keys of the account that are not listed
     state:
         required: false
         default: present
@@ -60,12 +75,22 @@ EXAMPLES = '''
 - ovh_ssh: state=present name=my_shiny_key path=/home/user/.ssh/id_dsa.pub
 # Remove my_shiny_key
 - ovh_ssh: state=absent name=my_shiny_key
+# Sync the team keys, removing the others
+- ovh_ssh:
+    exclusive: yes
+    keys:
+      - /home/user/.ssh/id_rsa.pub
+      - name: deploy
+        key: ssh-ed25519 AAAAC3NzaC1lZDI1NTE5AAAAI... deploy@ci
+        default: true
+      - "{{ lookup('file', 'keys/alice.pub') }}"
 '''
 
 import os
 import time
 import syslog
 import sys
+from multiprocessing.pool import ThreadPool
 
 try:
     import ovh
@@ -73,12 +98,124 @@ except ImportError:
     print "failed=True msg='ovh required for this module'"
     sys.exit(1)
 
+from ansible.module_utils.ovh_api import OvhApi, buildClient, exitJson, getChunk, objectCache
+
 OVH_CLIENT_ARGS = [
     "endpoint",
     "application_key",
     "application_secret",
     "consumer_key"
 ]
+# concurrent calls when syncing keys
+SYNC_WORKERS = 8
+
+
+def read_key(module, path):
+    try:
+        with open(path, "r") as f:
+            return f.read().replace("\n", '')
+    except IOError as e:
+        module.fail_json(msg='I/O error({0}):{1}'.format(e.errno, e.strerror))
+
+
+def same_key(a, b):
+    """ Same public key, whitespace aside """
+    return a is not None and b is not None and a.split() == b.split()
+
+
+def desired_keys(module, items):
+    """ name: (key, default) of the keys items, default None meaning unchanged """
+    keys = dict()
+    for item in items:
+        if not isinstance(item, dict):
+            if os.path.isfile(item):
+                item = dict(path=item)
+            else:
+                item = dict(key=item)
+        key = item.get('key')
+        if item.get('path'):
+            key = read_key(module, item['path'])
+        if not key:
+            module.fail_json(msg='key without path nor key: {}'.format(item))
+        name = item.get('name')
+        if not name and item.get('path'):
+            name = os.path.basename(item['path'])
+            if name.endswith('.pub'):
+                name = name[:-len('.pub')]
+        if not name and len(key.split()) > 2:
+            name = key.split()[2]
+        if not name:
+            module.fail_json(msg='key without name nor comment: {}'.format(key))
+        if name in keys:
+            module.fail_json(msg='key {} listed twice'.format(name))
+        default = item.get('default')
+        keys[name] = (key, module.boolean(default) if default is not None else None)
+    return keys
+
+
+def sync_key(client, name, current, key, default):
+    """ Makes the key name match key and default, current being its API state or None.
+        Returns the change made """
+    if current is not None and not same_key(current['key'], key):
+        # keys can't be modified, only replaced
+        client.delete('/me/sshKey/{}', name)
+    if current is None or not same_key(current['key'], key):
+        client.post("/me/sshKey", key=key, keyName=name)
+        if default is None and current is not None:
+            default = current['default']
+        if default:
+            client.put('/me/sshKey/{}', name, default=True)
+        return "added" if current is None else "replaced"
+    if default is not None and current['default'] != default:
+        client.put('/me/sshKey/{}', name, default=default)
+        return "updated"
+    return None
+
+
+def sync_keys(module, client):
+    """ Syncs the account keys with the keys option, with as few calls as possible """
+    keys = desired_keys(module, module.params.get('keys'))
+    try:
+        # from the API: a listing cached for its TTL may miss or still have keys
+        existing = client.get_fresh('/me/sshKey')
+    except ovh.APIError as e:
+        module.fail_json(msg="Unable to list keys: API Error: ' {}".format(e))
+
+    def apply(change):
+        name, current = change
+        try:
+            if name not in keys:
+                client.delete('/me/sshKey/{}', name)
+                return name, "removed", None
+            key, default = keys[name]
+            return name, sync_key(client, name, current, key, default), None
+        except ovh.APIError as e:
+            return name, None, '{0}: {1}'.format(name, e)
+
+    pool = ThreadPool(SYNC_WORKERS)
+    try:
+        listed = [name for name in existing if name in keys]
+        # a single batch call, where the API allows
+        current = dict(zip(listed, getChunk(client, '/me/sshKey/{}', listed, fresh=True)))
+        errors = [str(value) for value in current.values() if isinstance(value, ovh.APIError)]
+        if errors:
+            module.fail_json(msg="Unable to fetch keys: API Error: ' {}".format('; '.join(errors)))
+        changes = [(name, current.get(name)) for name in sorted(keys)]
+        if module.params.get('exclusive'):
+            changes.extend((name, None) for name in sorted(existing) if name not in keys)
+        results = pool.map(apply, changes)
+    finally:
+        pool.close()
+
+    report = dict(added=[], replaced=[], updated=[], removed=[])
+    for name, change, error in results:
+        if change is not None:
+            report[change].append(name)
+    errors = [error for name, change, error in results if error is not None]
+    changed = any(report.values())
+    if errors:
+        module.fail_json(msg='sync failed - {}'.format('; '.join(errors)), changed=changed, **report)
+    exitJson(module, client, changed=changed, **report)
 
 
 def main():
@@ -86,7 +223,9 @@ def main():
     module = AnsibleModule(
         argument_spec=dict(
             path=dict(default=None),
-            name=dict(required=True),
+            name=dict(default=None),
+            keys=dict(default=None, type='list'),
+            exclusive=dict(default=False, type='bool'),
             state=dict(default='present', choices=['present', 'absent']),
             default=dict(default=None),
             endpoint=dict(default=None,aliases=['region']),
@@ -108,28 +247,30 @@ def main():
     for arg in OVH_CLIENT_ARGS:
         connect_info[arg] = module.params.get(arg)
     try:
-        client = ovh.Client(**connect_info)
-    except:
-        e = sys.exc_info()[0]
+        client = OvhApi(buildClient(**connect_info), cache=objectCache())
+    except ovh.APIError as e:
         module.fail_json(msg="Can't connect to API: ' {}".format(e))
 
+    if module.params.get('keys') is not None:
+        sync_keys(module, client)
+    if ssh_key_name is None:
+        module.fail_json(msg='Missing name argument')
+
     try:
-        key_info = client.get('/me/sshKey/{}'.format(ssh_key_name))
+        key_info = client.get('/me/sshKey/{}', ssh_key_name)
     except ovh.ResourceNotFoundError:
         key_info= {'key': None, 'sshKey': None, 'default':None}
-    except:
-        e = sys.exc_info()[0]
-        module.fail_json(msg="Unable to fetch key {0}: Unknown API Error: ' {1}".format(ssh_key_namessh_key_name,e))
+    except ovh.APIError as e:
+        module.fail_json(msg="Unable to fetch key {0}: API Error: ' {1}".format(ssh_key_name,e))
 
     if key_state == "absent":
         if key_info['key'] == None:
-            module.exit_json(changed=False)
+            exitJson(module, client, changed=False)
         try:
-            client.delete('/me/sshKey/{}'.format(ssh_key_name))
-        except:
-            e = sys.exc_info()[0]
+            client.delete('/me/sshKey/{}', ssh_key_name)
+        except ovh.APIError as e:
             module.fail_json(msg='delete fail {}'.format(e))
-        module.exit_json(changed=True)
+        exitJson(module, client, changed=True)
 
     if key_state == "present":
         change=False
@@ -148,35 +289,31 @@ def main():
                                                         e.strerror))
 
         if key_info['key'] == ssh_key and key_info['default'] == isDefault and key_info['keyName'] == ssh_key_name:
-            module.exit_json(change=False)
+            exitJson(module, client, change=False)
 
         if key_info['default'] is not None and key_info['key'] == ssh_key and isDefault is not None:
             try:
-                client.put('/me/sshKey/{}'.format(ssh_key_name),default=isDefault)
-            except:
-                e = sys.exc_info()[0]
+                client.put('/me/sshKey/{}', ssh_key_name, default=isDefault)
+            except ovh.APIError as e:
                 module.fail_json(msg='put failed {}'.format(e))
-            module.exit_json(msg="key updated", changed=True)
+            exitJson(module, client, msg="key updated", changed=True)
 
         if key_info['default'] is not None:
             try:
-                client.delete('/me/sshKey/{}'.format(ssh_key_name))
-            except:
-                e = sys.exc_info()[0]
+                client.delete('/me/sshKey/{}', ssh_key_name)
+            except ovh.APIError as e:
                 module.fail_json(msg='delete failed {}'.format(e))
         try:
             client.post("/me/sshKey", key=ssh_key, keyName=ssh_key_name)
-        except:
-            e = sys.exc_info()[0]
+        except ovh.APIError as e:
             module.fail_json(msg='post fail {}'.format(e))
         isDefault = isDefault if isDefault is not None else key_info["default"]
         if isDefault is not None:
             try:
-                client.put('/me/sshKey/{}'.format(ssh_key_name),default=isDefault)
-            except:
-                e = sys.exc_info()[0]
+                client.put('/me/sshKey/{}', ssh_key_name, default=isDefault)
+            except ovh.APIError as e:
                 module.fail_json(msg='update default failed - inconsistency may happen {}'.format(e))
-        module.exit_json(changed=True)
+        exitJson(module, client, changed=True)
 
     module.fail_json(msg="you shouln't be here !")
 
@@ -17,16 +17,50 @@ options:
     name:
         required: true
         description:
-            - service name (aka ovh_name) of the VPS
+            - service name (aka ovh_name) of the VPS, or a list of them.
+              Names may have shell wildcards, matched against the VPS of the
+              account (vps*.ovh.net). With a list, the action runs on every
+              VPS concurrently and the results are reported per VPS
     action:
     template:
         require: false
         description:
-            - reinstall action only. templateid (from /vps/template)
+            - reinstall action only. Template id (from /vps/{name}/templates),
+              or template name or distribution (Debian 9 (Stretch), debian9),
+              case, spaces and punctuation aside. A distribution matching
+              several templates picks the 64 bits one.
+              Names are resolved against the template catalog of the VPS
+              model, fetched once per model and run, and kept in the object
+              cache (catalog/vps/{} TTL, a day by default)
     ssh_key:
         require: false
         description:
             - reinstall action only. sshkey (from /me/sshKeys)
+    wait:
+        require: false
+        default: false
+        description:
+            - wait for the task of the action to end and the VPS to be
+              running (reboot, start, reinstall) or stopped (stop).
+              The task is polled every second at first, then less and less
+              often, up to every 30 seconds
+    wait_timeout:
+        require: false
+        default: 900
+        description:
+            - seconds to wait before failing
+    concurrency:
+        require: false
+        default: 10
+        description:
+            - list of names only. VPS handled at the same time
+    serial:
+        require: false
+        description:
+            - list of names only. Runs the action on batches of this many VPS
+              (or this percentage of them, as in 25%), one batch after the
+              other. A batch with a failure stops the next ones, set wait to
+              have each batch complete before the next starts
 '''
 
 EXAMPLES = '''
@@ -34,11 +68,66 @@ EXAMPLES = '''
 ovh_vps: name="vps00000.ovh.net" action=reboot
 # stop vps
 ovh_vps: name="vps00000.ovh.net" action=stop
+# reboot a vps, and wait until it is running again
+ovh_vps: name="vps00000.ovh.net" action=reboot wait=yes wait_timeout=300
+
+# reinstall many vps at once, then wait for all of them
+- ovh_vps: name={{ item }} action=reinstall template=debian9 ssh_key=mykey wait=yes wait_timeout=3600
+  with_items: "{{ groups['vps'] | map('extract', hostvars, 'name') | list }}"
+  async: 3700
+  poll: 0
+  register: reinstalls
+- async_status: jid={{ item.ansible_job_id }}
+  with_items: "{{ reinstalls.results }}"
+  register: jobs
+  until: jobs.finished
+  retries: 120
+  delay: 30
+
+# reboot all the vps of an inventory group, 20 at a time, a quarter of them after the other
+- ovh_vps:
+    name: "{{ groups['vps'] | map('extract', hostvars, 'name') | list }}"
+    action: reboot
+    concurrency: 20
+    serial: 25%
+    wait: yes
+  run_once: true
+  delegate_to: localhost
+# stop all the vps of a cluster
+ovh_vps: name="vps*.cluster.example.com" action=stop
+'''
+
+RETURN = '''
+task:
+    description: task of the action, as last polled when waiting
+    returned: changed
+    type: dict
+state:
+    description: state of the VPS at the end of the wait
+    returned: changed and wait
+    type: string
+elapsed:
+    description: seconds spent waiting
+    returned: changed and wait
+    type: float
+template_id:
+    description: id of the template installed
+    returned: changed reinstall
+    type: int
+vps:
+    description: list of names only. changed, msg, failed, task, state and
+                 elapsed of each VPS, by name, skipped when an earlier batch failed
+    returned: always
+    type: dict
 '''
 import os
+import re
 import time
 import syslog
 import sys
+import threading
+from fnmatch import fnmatchcase
+from multiprocessing.pool import ThreadPool
 
 try:
     import ovh
@@ -46,6 +135,111 @@ except ImportError:
     print "failed=True msg='ovh required for this module'"
     sys.exit(1)
 
+from ansible.module_utils.ovh_api import MISSING, OvhApi, buildClient, exitJson, getChunk, objectCache
+
+# state an action leaves the VPS in
+TARGET_STATES = {
+    "reboot": "running",
+    "start": "running",
+    "stop": "stopped",
+    "reinstall": "running",
+}
+# state a VPS must be in for an action
+REQUIRED_STATES = {
+    "reboot": "running",
+    "start": "stopped",
+    "stop": "running",
+    "reinstall": "running",
+}
+# task states that won't change any more
+TASK_DONE = ["done"]
+TASK_FAILED = ["error", "cancelled"]
+# polling interval bounds, in seconds, and growth
+POLL_MIN = 1.0
+POLL_MAX = 30.0
+POLL_FACTOR = 1.5
+# object cache key of the template catalog of a VPS model, see get_catalog
+TEMPLATE_CATALOG = 'catalog/vps/{}'
+# catalogs fetched by this run, per endpoint and model, shared by its threads.
+# One lock per catalog, fetched once while the other models are fetched concurrently
+CATALOGS = dict()
+CATALOG_LOCKS = dict()
+CATALOGS_LOCK = threading.Lock()
+
+
+class ActionError(Exception):
+    """ Failure of an action on a VPS, with what is known of it """
+
+    def __init__(self, msg, **result):
+        Exception.__init__(self, msg)
+        self.msg = msg
+        self.result = result
+
+
+class TemplateCatalog(object):
+    """ Templates of a VPS model, indexed by name and distribution """
+
+    def __init__(self, templates):
+        self.names = dict()
+        self.distributions = dict()
+        for template in templates:
+            self.names.setdefault(normalize(template["name"]), []).append(template)
+            self.distributions.setdefault(normalize(template["distribution"]), []).append(template)
+
+    def resolve(self, spec):
+        """ Id of the template named spec, or of the distribution spec """
+        key = normalize(spec)
+        matches = self.names.get(key) or self.distributions.get(key) or []
+        if len(matches) > 1:
+            matches = [template for template in matches if template.get("bitFormat") == 64] or matches
+        if not matches:
+            raise ActionError("no template {}".format(spec))
+        if len(matches) > 1:
+            raise ActionError("template {} is ambiguous: {}".format(
+                spec, ", ".join(sorted(template["name"] for template in matches))))
+        return long(matches[0]["id"])
+
+
+def normalize(word):
+    """ Lowercase letters and digits of word, 'Debian 9 (Stretch)' is debian9stretch """
+    return re.sub(r'[^a-z0-9]', '', unicode(word).lower())
+
+
+def get_catalog(client, name, vps):
+    """ TemplateCatalog of the model of the VPS name, fetched from it once per run
+        and model, and kept in the object cache """
+    model = vps.get("model") or {}
+    # VPS without a model have their own catalog
+    key = "-".join(str(part) for part in (model.get("name"), model.get("version")) if part) or name
+    with CATALOGS_LOCK:
+        lock = CATALOG_LOCKS.setdefault((client.endpoint, key), threading.Lock())
+    with lock:
+        catalog = CATALOGS.get((client.endpoint, key))
+        if catalog is not None:
+            return catalog
+        templates = client.cached(TEMPLATE_CATALOG, key)
+        if templates is MISSING:
+            try:
+                ids = [str(template_id) for template_id in client.get('/vps/{}/templates', name)]
+            except ovh.APIError as e:
+                raise ActionError("Unable to list templates. API Error: ' {}".format(e))
+            templates = getChunk(client, '/vps/{}/templates/{}', ids, args=(name,))
+            errors = [str(template) for template in templates if isinstance(template, ovh.APIError)]
+            if errors:
+                raise ActionError("Unable to get templates. API Error: ' {}".format('; '.join(errors)))
+            client.store(TEMPLATE_CATALOG, (key,), templates)
+        catalog = CATALOGS[(client.endpoint, key)] = TemplateCatalog(templates)
+        return catalog
+
+
+def get_template_id(client, name, vps, template):
+    """ Id of template on the VPS name, an id as is, a name or distribution from its catalog """
+    if template is None:
+        raise ActionError("reinstall needs a template")
+    if str(template).isdigit():
+        return long(template)
+    return get_catalog(client, name, vps).resolve(template)
+
 
 def get_ovh_endpoints():
     lep = []
@@ -54,21 +248,150 @@ def get_ovh_endpoints():
     return lep
 
 
-def get_vps_info(module, client, name):
-    resp = None
+def get_vps_info(client, name, fresh=False):
+    """ The VPS, from the object cache unless fresh """
+    try:
+        if fresh:
+            return client.get_fresh('/vps/{}', name)
+        return client.get('/vps/{}', name)
+    except ovh.APIError as e:
+        raise ActionError("Unable to get status. API Error: ' {}".format(e))
+
+
+def expand_names(client, names):
+    """ names, their wildcards replaced by the matching VPS of the account """
+    if not any(c in name for name in names for c in '*?['):
+        return names
+    try:
+        services = client.get('/vps')
+    except ovh.APIError as e:
+        raise ActionError("Unable to list VPS. API Error: ' {}".format(e))
+    expanded = []
+    for name in names:
+        if any(c in name for c in '*?['):
+            expanded.extend(sorted(service for service in services if fnmatchcase(service, name)))
+        else:
+            expanded.append(name)
+    # first occurrence order, a VPS may match several patterns
+    seen = set()
+    return [name for name in expanded if not (name in seen or seen.add(name))]
+
+
+def get_batches(names, serial):
+    """ names in batches of serial, a count or a percentage """
+    if not serial:
+        return [names]
+    serial = str(serial).strip()
+    if serial.endswith('%'):
+        size = int(len(names) * float(serial[:-1]) / 100)
+    else:
+        size = int(serial)
+    size = max(size, 1)
+    return [names[i:i + size] for i in range(0, len(names), size)]
+
+
+def wait_for_task(client, name, action, task, timeout):
+    """ Polls the task of an action, then the VPS state, until the VPS is in
+        the state the action leaves it in. Returns the task, state and elapsed time """
+    start = time.time()
+    interval = POLL_MIN
+    state = None
+    while True:
+        if task is not None and task.get("state") not in TASK_DONE:
+            try:
+                task = client.get('/vps/{}/tasks/{}', name, task["id"])
+            except ovh.ResourceNotFoundError:
+                # ended tasks are removed after a while
+                task = dict(task, state="done")
+            except ovh.APIError as e:
+                raise ActionError("{} task: API Error: ' {}".format(action, e),
+                                  task=task, elapsed=time.time() - start)
+            if task["state"] in TASK_FAILED:
+                raise ActionError("{} task {}".format(action, task["state"]),
+                                  task=task, elapsed=time.time() - start)
+        # no task to follow when the API returned none
+        if task is None or task["state"] in TASK_DONE:
+            state = get_vps_info(client, name, fresh=True)["state"]
+            if state == TARGET_STATES[action]:
+                return task, state, time.time() - start
+        elapsed = time.time() - start
+        if elapsed >= timeout:
+            raise ActionError("timeout waiting for {} of {}".format(action, name),
+                              task=task, state=state, elapsed=elapsed)
+        time.sleep(min(interval, timeout - elapsed))
+        interval = min(interval * POLL_FACTOR, POLL_MAX)
+
+
+def run_action(client, name, params):
+    """ Runs the action on a VPS, waiting for it when asked to. Returns its result,
+        raises ActionError when it fails """
+    action = params.get('action')
+    vps = get_vps_info(client, name)
+    if action is None:
+        return dict(changed=False)
+
+    if vps["state"] != REQUIRED_STATES[action]:
+        # tested only when VPS is running
+        if action == 'reinstall':
+            raise ActionError('not tested on a not running VPS')
+        return dict(changed=False,
+                    msg="VPS state must be {} not {}".format(REQUIRED_STATES[action], vps["state"]))
+
+    result = dict(changed=True)
+    try:
+        if action == 'reinstall':
+            result["template_id"] = get_template_id(client, name, vps, params.get('template'))
+            task = client.post('/vps/{}/reinstall', name,
+                               language=params.get('language'),
+                               templateId=result["template_id"],
+                               sshKey=params.get('ssh_key').split(" "))
+        else:
+            task = client.post('/vps/{}/' + action, name)
+    except ovh.APIError as e:
+        raise ActionError("{}: API Error: ' {}".format(action, e))
+
+    result["task"] = task
+    if not params.get('wait'):
+        return result
+    result["task"], result["state"], result["elapsed"] = wait_for_task(client, name, action, task, params.get('wait_timeout'))
+    return result
+
+
+def run_one(client, name, params):
+    """ run_action, its failure as a result """
     try:
-        resp = client.get('/vps/{}'.format(name))
-    except:
-        e = sys.exc_info()[0]
-        module.fail_json(msg="Unable to get status. Unknown API Error: ' {}".format(e))
-    return resp
+        return run_action(client, name, params)
+    except ActionError as e:
+        return dict(e.result, failed=True, changed=False, msg=e.msg)
+
+
+def run_all(module, client, names, params):
+    """ Runs the action on names, concurrently, batch after batch """
+    results = dict()
+    pool = ThreadPool(min(params.get('concurrency'), len(names)) or 1)
+    try:
+        for batch in get_batches(names, params.get('serial')):
+            if any(result.get("failed") for result in results.values()):
+                results.update((name, dict(changed=False, skipped=True, msg="an earlier batch failed"))
+                               for name in batch)
+                continue
+            results.update(zip(batch, pool.map(lambda name: run_one(client, name, params), batch)))
+    finally:
+        pool.close()
+
+    failed = sorted(name for name, result in results.items() if result.get("failed"))
+    changed = any(result["changed"] for result in results.values())
+    if failed:
+        module.fail_json(msg="{} failed on {}".format(params.get('action'), ", ".join(failed)),
+                         changed=changed, vps=results, timings=client.stats.summary())
+    exitJson(module, client, changed=changed, vps=results)
 
 
 def main():
     module = AnsibleModule(
         argument_spec=dict(
             state=dict(default='running'),
-            name=dict(require=True),
+            name=dict(require=True, type='raw'),
             action=dict(default=None, choices=[
                                     None,
                                     "reboot",
@@ -78,78 +401,40 @@ def main():
             template=dict(default=None),
             language=dict(default='en'),
             ssh_key=dict(default=None),
-            region=dict(default='ovh-eu', choices=get_ovh_endpoints())
+            region=dict(default='ovh-eu', choices=get_ovh_endpoints()),
+            wait=dict(default=False, type='bool'),
+            wait_timeout=dict(default=900, type='int'),
+            concurrency=dict(default=10, type='int'),
+            serial=dict(default=None)
         )
     )
 
     # get parameters
     name = module.params.get('name')
     action = module.params.get('action')
-    templateid = module.params.get('template')
     ssh_key = module.params.get('ssh_key')
-    language = module.params.get('language')
-
-
-    client = ovh.Client()
-    vps = get_vps_info(module, client, name)
-
-    if action == 'reboot':
-        if vps["state"] != "running":
-            module.exit_json(
-                msg="VPS state must be running, not {}".format(vps["state"]),
-                changed=False)
-        resp = None
-        try:
-            resp = client.post('/vps/{}/reboot'.format(name))
-        except:
-            e = sys.exc_info()[0]
-            module.fail_json(msg="reboot Unknown API Error: ' {}".format(e))
-        module.exit_json(changed=True)
-
-    if action == 'start':
-        if vps["state"] != "stopped":
-            module.exit_json(
-                msg="VPS state must be stopped not {}".format(vps["state"]),
-                changed=False)
-        resp = None
-        try:
-            resp = client.post('/vps/{}/start'.format(name))
-        except:
-            e = sys.exc_info()[0]
-            module.fail_json(msg="start Unknown API Error: ' {}".format(e))
-        module.exit_json(changed=True)
-
-    if action == 'stop':
-        if vps["state"] != "running":
-            module.exit_json(
-                msg="VPS state must be running not {}".format(vps["state"]),
-                changed=False)
-        resp = None
-        try:
-            resp = client.post('/vps/{}/stop'.format(name))
-        except:
-            e = sys.exc_info()[0]
-            module.fail_json(msg="stop: Unknown API Error: ' {}".format(e))
-        module.exit_json(changed=True)
-
-    if action == 'reinstall':
-        resp = None
-        # tested only when VPS is running
-        if vps["state"] != "running":
-            module.fail_json(msg='not tested on a not running VPS')
-        if ssh_key == None:
-            module.fail_json(msg='you must defined a ssh key')
-        try:
-            resp = client.post('/vps/{}/reinstall'.format(name),
-                            language=language,
-                            templateId=long(templateid),
-                            sshKey=ssh_key.split(" "))
-        except:
-            e = sys.exc_info()[0]
-            module.fail_json(msg="reinstall: Unknown API Error: ' {}".format(e))
-        module.exit_json(changed=True)
-
-    module.exit_json(changed=False)
+
+    if action == 'reinstall' and ssh_key == None:
+        module.fail_json(msg='you must defined a ssh key')
+
+    names = name if isinstance(name, list) else [name]
+    try:
+        client = OvhApi(buildClient(pool_size=max(module.params.get('concurrency'), 1)), cache=objectCache())
+    except ovh.APIError as e:
+        module.fail_json(msg="Can't connect to API: ' {}".format(e))
+    try:
+        names = expand_names(client, names)
+    except ActionError as e:
+        module.fail_json(msg=e.msg)
+
+    if isinstance(name, list) or names != [name]:
+        run_all(module, client, names, module.params)
+
+    try:
+        result = run_action(client, name, module.params)
+    except ActionError as e:
+        module.fail_json(msg=e.msg, **e.result)
+    exitJson(module, client, **result)
 
 
 # import module snippets
@@ -0,0 +1,607 @@
+# -*- coding: utf-8 -*-
+#
+# ovh_api: ovh.Client wrapper shared by the ovh modules and the inventory
+#
+# Modules import it as ansible.module_utils.ovh_api (module_utils directory
+# next to the playbook, or ANSIBLE_MODULE_UTILS), inventory/ovh.py loads it
+# from ../module_utils.
+
+import json
+import os
+import random
+import re
+import shutil
+import stat
+import tempfile
+import threading
+import time
+
+try:
+    from urllib import quote
+except ImportError:
+    from urllib.parse import quote
+
+import ovh
+import requests
+
+# /auth/time deltas are saved there between runs, unless told otherwise. One file per
+# user, see readTimeDeltas
+TIME_DELTA_CACHE_NAME = 'ansible-ovh-{}.time'.format(os.getuid())
+DEFAULT_TIME_DELTA_CACHE = os.path.join(tempfile.gettempdir(), TIME_DELTA_CACHE_NAME)
+# API objects shared by the inventory and the modules, see ObjectCache. One directory per
+# user, the objects of a shared one could have been planted by another user
+OBJECT_CACHE_NAME = 'ansible-ovh-{}.objects'.format(os.getuid())
+DEFAULT_OBJECT_CACHE = os.path.join(tempfile.gettempdir(), OBJECT_CACHE_NAME)
+# seconds objects are read back from the object cache, per endpoint template
+DEFAULT_OBJECT_TTLS = {
+    '/vps/{}': 300,
+    '/dedicated/server/{}': 300,
+    '/me/sshKey': 60,
+    '/me/sshKey/{}': 60,
+    # template catalogs of the VPS models, see ovh_vps
+    'catalog/vps/{}': 86400,
+}
+# value of a lookup missing the object cache
+MISSING = object()
+# keep-alive sessions per endpoint URL, shared by the clients of this process
+SESSIONS = dict()
+SESSIONS_LOCK = threading.Lock()
+# status and size of the last response received by each thread, see rememberResponse
+LAST_RESPONSE = threading.local()
+
+
+class CircuitOpenError(ovh.APIError):
+    """ Raised without calling the API while the circuit of an endpoint is open """
+
+
+def getStatus(error):
+    """ HTTP status of an API error, None when there was no response """
+    response = getattr(error, 'response', None)
+    return getattr(response, 'status_code', None)
+
+
+def isThrottled(error):
+    return getStatus(error) == 429
+
+
+def isRetriable(error, method):
+    """ Throttling is always retried: the call was refused. Connection errors and
+        5xx are retried for GET only, other calls may have been applied """
+    if isThrottled(error):
+        return True
+    if method != 'GET':
+        return False
+    if isinstance(error, (ovh.exceptions.HTTPError, ovh.exceptions.NetworkError)):
+        return True
+    status = getStatus(error)
+    return status is not None and status >= 500
+
+
+def parsePairs(value):
+    """ Parses 'prefix:number' pairs, as in '/vps:20, /dedicated:10' """
+    pairs = dict()
+    for item in re.sub(r'\s+', '', value or '').split(','):
+        if item:
+            prefix, number = item.rsplit(':', 1)
+            pairs[prefix] = float(number)
+    return pairs
+
+
+def parseRateLimits(value):
+    """ Parses 'prefix:calls per second' pairs, as in '/vps:20, /dedicated:10'.
+        ValueError on rates of 0 or less, which would never allow a call """
+    rate_limits = parsePairs(value)
+    for prefix, rate in sorted(rate_limits.items()):
+        if rate <= 0:
+            raise ValueError("rate limit of {0} must be more than 0, not {1}".format(prefix, rate))
+    return rate_limits
+
+
+def rememberResponse(response, *args, **kwargs):
+    """ Response hook of the pooled sessions, lets OvhApi record what the client doesn't return """
+    LAST_RESPONSE.status = response.status_code
+    LAST_RESPONSE.size = len(response.content)
+
+
+def percentile(values, p):
+    """ Nearest rank percentile of sorted values """
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+class CallStats(object):
+    """ Endpoint template, latency, status, retries and response size of API calls """
+
+    def __init__(self):
+        self.calls = dict()
+        self.lock = threading.Lock()
+
+    def record(self, label, method, template, latency, status, retries, size):
+        key = (label, method, template)
+        with self.lock:
+            stats = self.calls.setdefault(key, {"latencies": [], "statuses": {}, "retries": 0, "bytes": 0})
+            stats["latencies"].append(latency)
+            stats["statuses"][str(status)] = stats["statuses"].get(str(status), 0) + 1
+            stats["retries"] += retries
+            stats["bytes"] += size or 0
+
+    def summary(self):
+        """ Per endpoint count, p50/p95/max/total seconds, statuses, retries and bytes """
+        summary = dict()
+        with self.lock:
+            for (label, method, template), stats in self.calls.items():
+                latencies = sorted(stats["latencies"])
+                name = "{0} {1}".format(method, template)
+                if label:
+                    name = "{0} {1}".format(label, name)
+                summary[name] = {
+                    "count": len(latencies),
+                    "p50": round(percentile(latencies, 50), 4),
+                    "p95": round(percentile(latencies, 95), 4),
+                    "max": round(latencies[-1], 4),
+                    "total": round(sum(latencies), 4),
+                    "statuses": dict(stats["statuses"]),
+                    "retries": stats["retries"],
+                    "bytes": stats["bytes"],
+                }
+        return summary
+
+    def report(self):
+        """ summary as a text table, the endpoints taking the most time first """
+        summary = self.summary()
+        lines = ["{0:>7} {1:>8} {2:>8} {3:>8} {4:>9} {5:>7} {6:>10}  {7}".format(
+            "count", "p50", "p95", "max", "total", "retries", "bytes", "endpoint")]
+        for name in sorted(summary, key=lambda name: -summary[name]["total"]):
+            stats = summary[name]
+            lines.append("{0:>7} {1:>8.3f} {2:>8.3f} {3:>8.3f} {4:>9.3f} {5:>7} {6:>10}  {7}".format(
+                stats["count"], stats["p50"], stats["p95"], stats["max"], stats["total"],
+                stats["retries"], stats["bytes"], name))
+        return "\n".join(lines) + "\n"
+
+
+def getChunk(api, template, keys, args=(), batch_size=50, unsupported=None, fresh=False):
+    """ Gets template with args and key for every key, batch_size keys per call using the API batch mode.
+        Falls back to one call per key when a batch fails or the endpoint does not support batching,
+        remembering such templates in the unsupported set.
+        A key that can't be fetched gets the API error as value. fresh skips the object cache reads """
+    if unsupported is None:
+        unsupported = set()
+    results = dict()
+    keys = list(keys)
+    for key in ([] if fresh else keys):
+        value = api.cached(template, *(tuple(args) + (key,)))
+        if value is not MISSING:
+            results[key] = value
+    missing = [key for key in keys if key not in results]
+    for i in range(0, len(missing), batch_size):
+        chunk = missing[i:i + batch_size]
+        if len(chunk) < 2 or template in unsupported:
+            continue
+        try:
+            batch = api.get_fresh(template + '?$batch=,', *(tuple(args) + (','.join(chunk),)))
+        except ovh.BadParametersError:
+            unsupported.add(template)
+            continue
+        except ovh.APIError:
+            continue
+        if not isinstance(batch, list) or not all(isinstance(item, dict) and 'key' in item for item in batch):
+            unsupported.add(template)
+            continue
+        for item in batch:
+            key = item['key']
+            if key not in chunk:
+                # escaped keys may be answered unescaped
+                key = quote(key, safe='')
+            if not item.get('error'):
+                results[key] = item['value']
+                api.store(template, tuple(args) + (key,), item['value'])
+
+    for key in keys:
+        if key not in results:
+            try:
+                results[key] = (api.get_fresh if fresh else api.get)(template, *(tuple(args) + (key,)))
+            except ovh.APIError as e:
+                results[key] = e
+    return [results[key] for key in keys]
+
+
+def atomicWriteJson(filename, data):
+    """ Writes data to a temporary file renamed into place, readers never see a partial file """
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(filename), prefix='.' + os.path.basename(filename))
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(data, f)
+        os.rename(tmp, filename)
+    except:
+        os.unlink(tmp)
+        raise
+
+
+def isPrivateDirectory(directory):
+    """ Creates directory with mode 0700 if it doesn't exist. True if it is a directory
+        (not a link) of the current user that nobody else can write to """
+    try:
+        os.makedirs(directory, 0o700)
+    except OSError:
+        # it exists, or can't be created
+        pass
+    try:
+        info = os.lstat(directory)
+    except OSError:
+        return False
+    return stat.S_ISDIR(info.st_mode) and info.st_uid == os.getuid() and not info.st_mode & 0o022
+
+
+class ObjectCache(object):
+    """ API objects saved one file per object, shared by the inventory, which
+        writes the objects it fetches, and the modules, which read them back.
+        An object is read while younger than the TTL of its endpoint template,
+        templates without a TTL are not cached.
+
+        Objects live in directory/<endpoint>/<path segments>/@, so a write
+        through the API drops the object it changes, its ancestors and every
+        object under its parent with a single rename, see invalidate.
+
+        directory is created readable by its user only. The cache is disabled
+        unless directory belongs to the current user and nobody else can write to it """
+
+    def __init__(self, directory, ttls):
+        self.directory = directory
+        self.ttls = ttls
+        self.trusted = isPrivateDirectory(directory)
+
+    def segments(self, endpoint, template, args):
+        """ Path of the object of template and args, as quoted directory names """
+        args = list(args)
+        segments = [quote(endpoint, safe='')]
+        for part in template.strip('/').split('/'):
+            count = part.count('{}')
+            segments.append(quote(part.format(*args[:count]), safe=''))
+            del args[:count]
+        return segments
+
+    def get(self, endpoint, template, args):
+        """ The object, MISSING if it isn't cached or is too old """
+        ttl = self.ttls.get(template, 0)
+        if ttl <= 0 or not self.trusted:
+            return MISSING
+        filename = os.path.join(self.directory, *(self.segments(endpoint, template, args) + ['@']))
+        try:
+            if time.time() - os.path.getmtime(filename) >= ttl:
+                return MISSING
+            with open(filename, 'r') as f:
+                return json.load(f)
+        except (IOError, OSError, ValueError):
+            return MISSING
+
+    def put(self, endpoint, template, args, value):
+        """ Saves the object, if its template has a TTL. Best effort """
+        if self.ttls.get(template, 0) <= 0 or not self.trusted:
+            return
+        directory = os.path.join(self.directory, *self.segments(endpoint, template, args))
+        try:
+            os.makedirs(directory)
+        except OSError:
+            # concurrent writers create it too
+            if not os.path.isdir(directory):
+                return
+        try:
+            atomicWriteJson(os.path.join(directory, '@'), value)
+        except (IOError, OSError):
+            pass
+
+    def invalidate(self, endpoint, template, args):
+        """ Drops the objects a write to template with args may have changed:
+            the object, its ancestors, and everything under its parent """
+        if not self.trusted:
+            return
+        segments = self.segments(endpoint, template, args)
+        parent = os.path.join(self.directory, *segments[:-1])
+        # renamed first, readers and writers never see a partly removed tree
+        trash = '{0}.{1}.{2}'.format(parent, os.getpid(), threading.current_thread().ident)
+        try:
+            os.rename(parent, trash)
+        except OSError:
+            pass
+        else:
+            shutil.rmtree(trash, ignore_errors=True)
+        for i in range(2, len(segments) - 1):
+            try:
+                os.unlink(os.path.join(self.directory, *(segments[:i] + ['@'])))
+            except OSError:
+                pass
+
+
+def objectCache(directory=None, ttls=None):
+    """ ObjectCache in directory (OVH_OBJECT_CACHE, or the temporary directory), with ttls
+        (DEFAULT_OBJECT_TTLS updated by OVH_OBJECT_CACHE_TTLS, as in '/vps/{}:60').
+        None when OVH_OBJECT_CACHE is 'none' """
+    if directory is None:
+        directory = os.environ.get('OVH_OBJECT_CACHE') or DEFAULT_OBJECT_CACHE
+    if directory.lower() == 'none':
+        return None
+    if ttls is None:
+        ttls = dict(DEFAULT_OBJECT_TTLS)
+        # 'template:seconds' pairs, 0 not caching template
+        ttls.update(parsePairs(os.environ.get('OVH_OBJECT_CACHE_TTLS')))
+    return ObjectCache(directory, ttls)
+
+
+def exitJson(module, api, **kwargs):
+    """ module.exit_json, with the timings of the API calls """
+    kwargs["timings"] = api.stats.summary()
+    module.exit_json(**kwargs)
+
+
+def getSession(endpoint, pool_size, session_class):
+    """ Pooled keep-alive session of an endpoint URL, created on first use. session_class
+        is the one of the client, ovh may bundle its own requests and only wrap its errors """
+    with SESSIONS_LOCK:
+        if endpoint not in SESSIONS:
+            session = session_class()
+            session.hooks['response'].append(rememberResponse)
+            for prefix in ('https://', 'http://'):
+                # adapter of the same requests as the session
+                adapter_class = type(session.get_adapter(prefix))
+                session.mount(prefix, adapter_class(pool_connections=1, pool_maxsize=pool_size))
+            SESSIONS[endpoint] = session
+        return SESSIONS[endpoint]
+
+
+def readTimeDeltas(filename):
+    """ Saved deltas, none unless filename belongs to the current user and nobody else can
+        write to it: a planted delta would make every signed call fail """
+    try:
+        with open(filename, 'r') as f:
+            info = os.fstat(f.fileno())
+            if info.st_uid != os.getuid() or info.st_mode & 0o022:
+                return dict()
+            return json.load(f)
+    except (IOError, OSError, ValueError):
+        return dict()
+
+
+def writeTimeDeltas(filename, deltas):
+    """ Written to a temporary file renamed into place, concurrent runs never read a partial file.
+        Best effort: a delta that can't be saved is computed again next time """
+    try:
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(filename)),
+                                   prefix='.' + os.path.basename(filename))
+    except (IOError, OSError):
+        return
+    try:
+        with os.fdopen(fd, 'w') as f:
+            json.dump(deltas, f)
+        os.rename(tmp, filename)
+    except (IOError, OSError):
+        os.unlink(tmp)
+
+
+def buildClient(time_delta_cache=DEFAULT_TIME_DELTA_CACHE, time_delta_max_age=3600, pool_size=10, **kwargs):
+    """ ovh.Client (kwargs being its arguments) using the pooled session of its endpoint,
+        which may also be given as an API URL,
+        and a time delta saved for time_delta_max_age seconds instead of an /auth/time
+        call per client. time_delta_cache None disables saving it """
+    endpoint = kwargs.get('endpoint') or os.environ.get('OVH_ENDPOINT')
+    if endpoint and re.match(r'^https?://', endpoint):
+        # an API URL rather than a region, e.g. bench/mock_api.py
+        ovh.client.ENDPOINTS.setdefault(endpoint, endpoint)
+        kwargs['endpoint'] = endpoint
+    client = ovh.Client(**kwargs)
+    endpoint = getattr(client, '_endpoint', None)
+    if endpoint is None:
+        # not an ovh.Client version we know the internals of
+        return client
+    # ovh versions without a session of their own call requests directly
+    session_class = type(client._session) if getattr(client, '_session', None) else requests.Session
+    client._session = getSession(endpoint, pool_size, session_class)
+
+    if time_delta_cache is not None:
+        deltas = readTimeDeltas(time_delta_cache)
+        delta, stamp = deltas.get(endpoint, (None, 0))
+        if delta is not None and time.time() - stamp < time_delta_max_age:
+            client._time_delta = delta
+        else:
+            try:
+                deltas[endpoint] = (client.time_delta, time.time())
+            except requests.RequestException as e:
+                raise ovh.exceptions.HTTPError("Low HTTP request failed error", e)
+            writeTimeDeltas(time_delta_cache, deltas)
+    return client
+
+
+class TokenBucket(object):
+    """ Allows rate calls per second on average, with bursts of up to burst calls """
+
+    def __init__(self, rate, burst=None):
+        self.rate = float(rate)
+        self.burst = float(burst or max(rate, 1))
+        self.tokens = self.burst
+        self.stamp = time.time()
+        self.lock = threading.Lock()
+
+    def take(self):
+        """ Waits until a call is allowed """
+        while True:
+            with self.lock:
+                now = time.time()
+                self.tokens = min(self.burst, self.tokens + (now - self.stamp) * self.rate)
+                self.stamp = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+
+class CircuitBreaker(object):
+    """ Opens after threshold consecutive failures: calls then fail right away
+        for reset seconds, after which a single trial call is let through """
+
+    def __init__(self, threshold, reset):
+        self.threshold = threshold
+        self.reset = reset
+        self.failures = 0
+        self.opened = None
+        self.lock = threading.Lock()
+
+    def before(self, prefix):
+        with self.lock:
+            if self.opened is None:
+                return
+            if time.time() - self.opened < self.reset:
+                raise CircuitOpenError("circuit open for {0} after {1} failures".format(prefix, self.failures))
+            # half open: this call tries, the others keep failing until it succeeds
+            self.opened = time.time()
+
+    def success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened = None
+
+    def failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.threshold:
+                self.opened = time.time()
+
+
+class OvhApi(object):
+    """ Wraps an ovh.Client with a client side rate limit per endpoint prefix,
+        retries with jittered exponential backoff on throttling, 5xx and
+        connection errors, and a circuit breaker per top level endpoint.
+        Every call is recorded in stats, which may be shared by several clients,
+        under label (the endpoint URL by default).
+        With an ObjectCache, GETs are saved to it, and answered from it unless
+        cache_reads is False; POST, PUT and DELETE invalidate what they change.
+
+        Paths are given as templates and their arguments,
+        api.get('/vps/{}/ips', name) calls /vps/<name>/ips """
+
+    def __init__(self, client, rate_limits=None, retries=3, backoff=0.5, max_backoff=30,
+                 breaker_threshold=5, breaker_reset=30, stats=None, label=None, cache=None, cache_reads=True):
+        self.client = client
+        self.stats = stats if stats is not None else CallStats()
+        self.endpoint = getattr(client, '_endpoint', None)
+        self.label = label if label is not None else self.endpoint
+        # no cache for clients we don't know the endpoint of
+        self.cache = cache if self.endpoint is not None else None
+        self.cache_reads = cache_reads
+        self.retries = retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.breaker_threshold = breaker_threshold
+        self.breaker_reset = breaker_reset
+        # longest prefixes first, the most specific limit applies
+        self.buckets = sorted(((prefix, TokenBucket(rate)) for prefix, rate in (rate_limits or {}).items()),
+                              key=lambda item: -len(item[0]))
+        self.breakers = dict()
+        self.lock = threading.Lock()
+
+    def get(self, template, *args, **kwargs):
+        """ GET, from the object cache while fresh enough """
+        if not kwargs:
+            value = self.cached(template, *args)
+            if value is not MISSING:
+                return value
+        return self.get_fresh(template, *args, **kwargs)
+
+    def get_fresh(self, template, *args, **kwargs):
+        """ GET from the API, saved to the object cache """
+        result = self.call('GET', template, *args, **kwargs)
+        if not kwargs:
+            self.store(template, args, result)
+        return result
+
+    def post(self, template, *args, **kwargs):
+        return self.write('POST', template, *args, **kwargs)
+
+    def put(self, template, *args, **kwargs):
+        return self.write('PUT', template, *args, **kwargs)
+
+    def delete(self, template, *args, **kwargs):
+        return self.write('DELETE', template, *args, **kwargs)
+
+    def write(self, method, template, *args, **kwargs):
+        """ call, invalidating the cached objects it may change, even when it fails """
+        try:
+            return self.call(method, template, *args, **kwargs)
+        finally:
+            if self.cache is not None:
+                self.cache.invalidate(self.endpoint, template, args)
+
+    def cached(self, template, *args):
+        """ Object of a GET from the object cache, MISSING when not cached or too old """
+        if self.cache is None or not self.cache_reads:
+            return MISSING
+        start = time.time()
+        value = self.cache.get(self.endpoint, template, args)
+        if value is not MISSING:
+            self.stats.record(self.label, 'GET', template, time.time() - start, 'cached', 0, None)
+        return value
+
+    def store(self, template, args, value):
+        if self.cache is not None:
+            self.cache.put(self.endpoint, template, args, value)
+
+    def call(self, method, template, *args, **kwargs):
+        """ Calls the API, kwargs being the query (GET, DELETE) or body (POST, PUT) parameters """
+        path = template.format(*args) if args else template
+        breaker = self.breaker(path)
+        attempt = 0
+        status = None
+        start = time.time()
+        try:
+            while True:
+                breaker.before(self.top_level(path))
+                self.throttle(path)
+                LAST_RESPONSE.status = LAST_RESPONSE.size = None
+                try:
+                    try:
+                        result = getattr(self.client, method.lower())(path, **kwargs)
+                    except requests.RequestException as e:
+                        # raised as is by ovh versions using requests without wrapping its errors
+                        raise ovh.exceptions.HTTPError("Low HTTP request failed error", e)
+                except ovh.APIError as e:
+                    status = getStatus(e) or LAST_RESPONSE.status or type(e).__name__
+                    if not isRetriable(e, method):
+                        breaker.success()
+                        raise
+                    if attempt >= self.retries:
+                        breaker.failure()
+                        raise
+                    time.sleep(self.delay(attempt, e))
+                    attempt += 1
+                    continue
+                status = LAST_RESPONSE.status or 200
+                breaker.success()
+                return result
+        finally:
+            self.stats.record(self.label, method, template, time.time() - start, status, attempt,
+                              getattr(LAST_RESPONSE, 'size', None))
+
+    def delay(self, attempt, error):
+        """ Seconds to wait before a retry: Retry-After when throttled, jittered exponential backoff otherwise """
+        response = getattr(error, 'response', None)
+        retry_after = getattr(response, 'headers', {}).get('Retry-After') if response is not None else None
+        if retry_after:
+            try:
+                return min(float(retry_after), self.max_backoff)
+            except ValueError:
+                pass
+        return random.uniform(0, min(self.max_backoff, self.backoff * 2 ** attempt))
+
+    def throttle(self, path):
+        for prefix, bucket in self.buckets:
+            if path.startswith(prefix):
+                bucket.take()
+                return
+
+    def top_level(self, path):
+        return '/' + path.lstrip('/').split('/', 1)[0].split('?', 1)[0]
+
+    def breaker(self, path):
+        prefix = self.top_level(path)
+        with self.lock:
+            if prefix not in self.breakers:
+                self.breakers[prefix] = CircuitBreaker(self.breaker_threshold, self.breaker_reset)
+            return self.breakers[prefix]